@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Memory per entry of an in-memory metadata index (code -> metadata) held as
+Meta records and as the dicts older versions loaded from their json. Run from
+the repository root:
+
+    python benchmarks/memory.py -n 100000 1000000
+
+Entries have a 16 character filename and a sha-256 digest; half are keyed.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import tracemalloc
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tmper import web, record
+
+CODE_LEN = 4
+TYPES = ['application/pdf', 'image/png', 'text/plain', 'application/unknown']
+
+# a bcrypt hash, fixed width
+KEY = '$2b$12$' + 'x'*53
+
+def fields(i):
+    return {
+        'filename': 'report-{:05d}.pdf'.format(i % 100000),
+        'content_type': TYPES[i % len(TYPES)],
+        'expires': int(time.time()) + i, 'n': 1 + i % 3,
+        'key': KEY if i % 2 else None,
+        'digest': '{:064x}'.format(i), 'digest_algo': 'sha-256',
+    }
+
+def legacy(i):
+    """ As older versions wrote it, read back through json """
+    obj = fields(i)
+    obj['time'] = datetime.datetime.fromtimestamp(obj.pop('expires')).isoformat()
+    return json.loads(json.dumps(obj))
+
+def compact(i):
+    return record.Meta.decode(record.Meta(**fields(i)).encode())
+
+def measure(make, codes):
+    tracemalloc.start()
+    index = {code: make(i) for i, code in enumerate(codes)}
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # the index itself (keys and table) is the same for both
+    tracemalloc.start()
+    empty = dict.fromkeys(codes)
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del index, empty
+    return (size - base) / float(len(codes))
+
+def main():
+    parser = argparse.ArgumentParser(description='tmper metadata memory')
+    parser.add_argument('-n', '--num', type=int, nargs='+', default=[100000],
+        help='numbers of entries')
+    args = parser.parse_args()
+
+    codes = [''.join(c) for c in itertools.product(web.CHARS, repeat=CODE_LEN)]
+    print('{:>8} {:>12} {:>12}'.format('entries', 'dict B/ea', 'Meta B/ea'))
+    for num in args.num:
+        sample = codes[:num]
+        print('{:>8} {:>12.0f} {:>12.0f}'.format(
+            num, measure(legacy, sample), measure(compact, sample)
+        ))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Wall time of starting the tmper command line for each kind of invocation,
+measured over fresh interpreters. Run from the repository root:
+
+    python benchmarks/startup.py -n 20
+"""
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import subprocess
+
+CASES = [
+    ('python (baseline)', ['-c', 'pass']),
+    ('tmper --version', ['-m', 'tmper', '--version']),
+    ('import tmper.util', ['-c', 'import tmper.util']),
+    ('import tmper.web', ['-c', 'import tmper.web']),
+]
+
+def measure(args, n):
+    times = []
+    for i in range(n):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='tmper startup time')
+    parser.add_argument('-n', '--num', type=int, default=10, help='runs per case')
+    args = parser.parse_args()
+
+    print('{:<20} {:>10} {:>10}'.format('case', 'median ms', 'min ms'))
+    for name, cmd in CASES:
+        times = measure(cmd, args.num)
+        print('{:<20} {:>10.1f} {:>10.1f}'.format(
+            name, 1e3*times[len(times)//2], 1e3*times[0]
+        ))
+
+if __name__ == '__main__':
+    main()
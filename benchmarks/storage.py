@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Rates of creating, scanning (as on startup) and deleting stored files for
+each shard depth and number of files. Run from the repository root:
+
+    python benchmarks/storage.py -n 10000 100000 1000000 -d 0 1 2
+
+The scan is of a warm page cache, directly after the files were created.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tmper import web, record
+
+# long enough a code for a million files
+CODE_LEN = 4
+
+clock = getattr(time, 'monotonic', time.time)
+
+def run(num, depth, dir=None):
+    root = tempfile.mkdtemp(dir=dir)
+    try:
+        files = web.FileManager(root, clen=CODE_LEN, depth=depth)
+        codes = random.sample(sorted(files.all_codes), num)
+        meta = record.Meta(expires=int(time.time()) + 86400, n=1)
+        out = {}
+
+        start = clock()
+        for code in codes:
+            files.update_file(code, b'x')
+            files.update_meta(code, meta)
+        out['create'] = num / (clock() - start)
+
+        start = clock()
+        files.scan()
+        out['scan'] = clock() - start
+
+        start = clock()
+        files.recover()
+        out['recover'] = clock() - start
+
+        start = clock()
+        for code in codes:
+            files.delete_file(code)
+        out['delete'] = num / (clock() - start)
+        return out
+    finally:
+        shutil.rmtree(root)
+
+def main():
+    parser = argparse.ArgumentParser(description='tmper storage layout')
+    parser.add_argument('-n', '--num', type=int, nargs='+', default=[10000, 100000],
+        help='numbers of files')
+    parser.add_argument('-d', '--depth', type=int, nargs='+', default=[0, 1, 2],
+        help='shard depths')
+    parser.add_argument('--dir', type=str, default=None,
+        help='directory (and so filesystem) in which to run')
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>12} {:>10} {:>11} {:>12}'.format(
+        'files', 'depth', 'create/s', 'scan ms', 'recover ms', 'delete/s'
+    ))
+    for num in args.num:
+        for depth in args.depth:
+            r = run(num, depth, args.dir)
+            print('{:>8} {:>6} {:>12.0f} {:>10.1f} {:>11.1f} {:>12.0f}'.format(
+                num, depth, r['create'], 1e3*r['scan'], 1e3*r['recover'], r['delete']
+            ))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,17 @@ except IOError as e:
 
 templates = glob.glob('templates/*')
 
+# single source for the version, read without importing the package
+version = re.search(
+    r"__version__ = '(.*)'", read(os.path.join('tmper', '__init__.py'))
+).group(1)
+
 setup(
     name='tmper',
     license='MIT License',
     author='Matt Bierbaum',
     url='https://github.com/mattbierbaum/tmper',
-    version='0.5.7',
+    version=version,
 
     install_requires=[
         "tornado>=4.3",
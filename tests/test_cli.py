@@ -0,0 +1,19 @@
+import sys
+import unittest
+import subprocess
+
+
+class CLITests(unittest.TestCase):
+    def test_client_skips_server_imports(self):
+        code = (
+            "import sys, tmper.__main__, tmper.util;"
+            "print(' '.join(m for m in ('tornado', 'bcrypt', 'tmper.web', 'pkg_resources')"
+            " if m in sys.modules))"
+        )
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.strip(), b'')
+
+    def test_version(self):
+        import tmper
+        out = subprocess.check_output([sys.executable, '-m', 'tmper', '--version'])
+        self.assertIn(tmper.__version__.encode(), out)
@@ -0,0 +1,98 @@
+import io
+import time
+import shutil
+import asyncio
+import hashlib
+import requests
+import tempfile
+import unittest
+import multiprocessing
+
+import tmper.web
+from tmper.client import Client, AsyncClient
+
+ADDR = '127.0.0.1'
+PORT = 3336
+URL = 'http://{}:{}/'.format(ADDR, PORT)
+
+def serve(root):
+    tmper.web.serve(root, PORT, ADDR, client_rate=(1000, 1000))
+
+
+async def generate(count, size):
+    for i in range(count):
+        await asyncio.sleep(0)
+        yield bytes([i % 256]) * size
+
+
+class ClientTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.proc = multiprocessing.Process(target=serve, args=(cls.root,))
+        cls.proc.start()
+
+        start = time.time()
+        while True:
+            if time.time() - start > 10:
+                raise RuntimeError("Waited 10 sec for server to start, aborting")
+            try:
+                requests.get(URL)
+                break
+            except IOError:
+                time.sleep(0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.join()
+        shutil.rmtree(cls.root)
+
+    def test_sync(self):
+        with Client(URL) as client:
+            code = client.upload(io.BytesIO(b'sync' * 1000), name='a.txt', num=2)
+
+            out = client.download(code)
+            self.assertEqual((out.body, out.filename, out.content_type),
+                (b'sync' * 1000, 'a.txt', 'text/plain'))
+
+            sink = io.BytesIO()
+            self.assertIsNone(client.download(code, sink=sink).body)
+            self.assertEqual(sink.getvalue(), b'sync' * 1000)
+
+            with self.assertRaises(KeyError):
+                client.download(code)
+
+    def test_async_concurrent(self):
+        count, size, num = 16, 1 << 16, 50
+        expected = b''.join(bytes([i]) * size for i in range(count))
+
+        async def run():
+            async with AsyncClient(URL, max_connections=8) as client:
+                codes = await asyncio.gather(*[
+                    client.upload(generate(count, size), name='f{}'.format(i))
+                    for i in range(num)
+                ])
+                self.assertEqual(len(set(codes)), num)
+
+                hashes = {}
+                async def sink(code, chunk):
+                    await asyncio.sleep(0)
+                    hashes.setdefault(code, hashlib.sha256()).update(chunk)
+
+                outs = await asyncio.gather(*[
+                    client.download(c, sink=lambda chunk, c=c: sink(c, chunk))
+                    for c in codes
+                ])
+                self.assertEqual([o.filename for o in outs], ['f{}'.format(i) for i in range(num)])
+                self.assertEqual(set(h.hexdigest() for h in hashes.values()),
+                    set([hashlib.sha256(expected).hexdigest()]))
+
+                # the transfers shared the pool's connections
+                idle = sum(len(v) for v in client.pool.idle.values())
+                self.assertTrue(0 < idle <= 8)
+
+                with self.assertRaises(KeyError):
+                    await client.download(codes[0])
+
+        asyncio.run(run())
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import shutil
+import requests
+import tempfile
+import unittest
+import multiprocessing
+from urllib.parse import urljoin
+
+import tmper.web
+import tmper.util
+from tmper import cluster
+
+ADDR = '127.0.0.1'
+NODES = {
+    'a': 'http://{}:3334/'.format(ADDR),
+    'b': 'http://{}:3335/'.format(ADDR),
+}
+
+def serve(root, port, name, forward):
+    nodes = cluster.Cluster(NODES, name, forward=forward)
+    tmper.web.serve(root, port, ADDR, cluster=nodes)
+
+
+class RingTests(unittest.TestCase):
+    def test_owners(self):
+        prefixes = tmper.web.CHARS
+        three = cluster.Cluster(dict(NODES, c='http://c/'), 'a')
+        two = cluster.Cluster(NODES, 'a')
+
+        owners = set(three.owner(p) for p in prefixes)
+        self.assertEqual(owners, set(['a', 'b', 'c']))
+
+        # dropping a node only moves the prefixes it owned
+        for p in prefixes:
+            if three.owner(p) != 'c':
+                self.assertEqual(two.owner(p), three.owner(p))
+
+    def test_unknown_node(self):
+        with self.assertRaises(ValueError):
+            cluster.Cluster(NODES, 'z')
+
+
+class ClusterTests(unittest.TestCase):
+    forward = 'proxy'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.root)
+
+        cls.procs = [
+            multiprocessing.Process(target=serve, args=(
+                os.path.join(cls.root, name), int(url.rsplit(':', 1)[1].strip('/')),
+                name, cls.forward
+            )) for name, url in sorted(NODES.items())
+        ]
+        for proc in cls.procs:
+            proc.start()
+
+        start = time.time()
+        for url in NODES.values():
+            while True:
+                if time.time() - start > 10:
+                    raise RuntimeError("Waited 10 sec for servers to start, aborting")
+                try:
+                    requests.get(url)
+                    break
+                except IOError:
+                    time.sleep(0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        for proc in cls.procs:
+            proc.terminate()
+            proc.join()
+        shutil.rmtree(cls.root)
+
+    def upload(self, data, **kwargs):
+        with tempfile.NamedTemporaryFile(mode='wb') as f:
+            f.write(data)
+            f.flush()
+            return tmper.util.upload(NODES['a'], f.name, **kwargs)
+
+    def test_codes_partitioned(self):
+        nodes = cluster.Cluster(NODES, 'a')
+        for i in range(5):
+            code = self.upload(b'partitioned', num=3)
+            self.assertEqual(nodes.owner(code), 'a')
+
+            response = requests.get(urljoin(NODES['b'], code))
+            self.assertEqual(response.content, b'partitioned')
+
+        direct = requests.get(urljoin(NODES['b'], code), allow_redirects=False)
+        self.assertEqual(direct.status_code, 200 if self.forward == 'proxy' else 307)
+
+    def test_code_on_other_node(self):
+        nodes = cluster.Cluster(NODES, 'a')
+        code = next(c*3 for c in tmper.web.CHARS if nodes.owner(c) == 'b')
+
+        self.assertEqual(self.upload(b'remote', code=code), code)
+        response = requests.head(urljoin(NODES['a'], code), allow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response.headers['Location'], urljoin(NODES['b'], code))
+
+        response = requests.get(urljoin(NODES['a'], code))
+        self.assertEqual(response.content, b'remote')
+        self.assertEqual(requests.get(urljoin(NODES['b'], code)).status_code, 404)
+
+
+class ClusterRedirectTests(ClusterTests):
+    forward = 'redirect'
@@ -0,0 +1,47 @@
+import time
+import unittest
+import threading
+
+from tmper import debug
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplerTests(unittest.TestCase):
+    def test_samples_target_thread(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=spin, args=(stop,))
+        thread.start()
+
+        sampler = debug.Sampler(thread.ident, interval=0.001)
+        sampler.start()
+        time.sleep(0.2)
+        sampler.stop()
+        stop.set()
+        thread.join()
+
+        self.assertGreater(sampler.samples, 0)
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+        self.assertTrue(any('test_debug.py:spin' in line for line in lines))
+
+
+class TimingTests(unittest.TestCase):
+    def test_phases(self):
+        timings = debug.Timings(size=2)
+        for i in range(3):
+            timing = debug.Timing()
+            timing.mark('read')
+            timing.mark('write')
+            timings.record('GET MainHandler', 200, timing)
+
+        self.assertEqual(len(timings.entries), 2)
+        self.assertEqual([p for p, d in timing.phases], ['read', 'write'])
+        self.assertTrue(timing.header().startswith('read;dur='))
+
+        summary = timings.summary()
+        self.assertEqual(sorted(summary), ['read', 'total', 'write'])
+        self.assertEqual(summary['read']['count'], 2)
@@ -0,0 +1,226 @@
+import os
+import json
+import shutil
+import hashlib
+import datetime
+import unittest
+import tempfile
+import threading
+
+import tmper.web
+import tmper.cache
+import tmper.record
+
+
+def meta(minutes=10, n=1):
+    time = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+    return tmper.record.Meta(expires=tmper.record.epoch(time), n=n)
+
+
+class FileManagerTests(unittest.TestCase):
+    durability = 'none'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = tmper.web.FileManager(self.root, durability=self.durability)
+
+    def tearDown(self):
+        self.files.cancel_timers()
+        shutil.rmtree(self.root)
+
+    def test_save_and_open(self):
+        self.files.save_file('abc', b'data', meta())
+        data, m = self.files.open_file('abc')
+        self.assertEqual(data, b'data')
+        self.assertEqual(m.n, 1)
+        self.assertEqual(os.listdir(self.root), ['a'])
+        self.assertEqual(sorted(os.listdir(self.files.shard('abc'))), ['abc', 'abc.json'])
+
+    def test_recover_orphans(self):
+        self.files.save_file('abc', b'data', meta())
+        self.files.cancel_timers()
+
+        with open(os.path.join(self.root, tmper.web.TMP_PREFIX + 'x'), 'w') as f:
+            f.write('partial')
+        with open(os.path.join(self.root, 'def'), 'w') as f:
+            f.write('payload without meta')
+        with open(os.path.join(self.root, 'ghi'), 'w') as f:
+            f.write('payload with broken meta')
+        with open(os.path.join(self.root, 'ghi.json'), 'w') as f:
+            f.write('{"key": nul')
+
+        self.files.init()
+        self.assertEqual(os.listdir(self.root), ['a'])
+        self.assertEqual(sorted(os.listdir(self.files.shard('abc'))), ['abc', 'abc.json'])
+        self.assertEqual(self.files.used_codes, set(['abc']))
+
+
+class FileManagerBatchTests(FileManagerTests):
+    durability = 'batch'
+
+    def test_flush(self):
+        self.files.save_file('abc', b'data', meta())
+        self.files.flush()
+        self.assertEqual(self.files.pending, set())
+
+
+class FileManagerDurableTests(FileManagerTests):
+    durability = 'complete'
+
+
+class FileManagerStateTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = tmper.web.FileManager(self.root)
+
+    def tearDown(self):
+        self.files.cancel_timers()
+        shutil.rmtree(self.root)
+
+    def test_reserve(self):
+        self.assertEqual(self.files.reserve('abc'), 'abc')
+        self.assertIsNone(self.files.reserve('abc'))
+
+        self.files.unreserve('abc')
+        self.assertEqual(self.files.reserve('abc'), 'abc')
+
+    def test_expire_during_download(self):
+        self.files.save_file('abc', b'data', meta())
+        data, m = self.files.checkout('abc')
+
+        # expiry hides the file but leaves it on disk for the running download
+        self.files.timer_func('abc')
+        self.assertFalse(self.files.exists('abc'))
+        self.assertEqual(self.files.checkout('abc'), (None, None))
+        self.assertTrue(os.path.exists(self.files.path('abc')))
+
+        self.files.checkin('abc')
+        self.assertEqual(os.listdir(self.files.shard('abc')), [])
+        self.assertEqual(self.files.used_codes, set())
+
+    def test_consume_last(self):
+        self.files.save_file('abc', b'data', meta())
+        self.files.checkout('abc')
+        self.files.checkout('abc')
+
+        self.assertTrue(self.files.consume('abc'))
+        self.assertFalse(self.files.consume('abc'))
+
+        self.files.checkin('abc')
+        self.assertTrue(os.path.exists(self.files.path('abc')))
+        self.files.checkin('abc')
+        self.assertFalse(os.path.exists(self.files.path('abc')))
+
+    def test_concurrent_expiry(self):
+        codes = ['a{:02d}'.format(i) for i in range(50)]
+        for c in codes:
+            self.files.save_file(c, b'data', meta())
+
+        threads = [
+            threading.Thread(target=self.files.timer_func, args=(c,))
+            for c in codes for i in range(2)
+        ]
+        for t in threads:
+            t.start()
+        for c in codes:
+            self.files.lookup(c)
+            self.files.reserve()
+        for t in threads:
+            t.join()
+
+        self.assertFalse(any(self.files.exists(c) for c in codes))
+
+
+class ShardTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = tmper.web.FileManager(self.root, depth=0)
+
+    def tearDown(self):
+        self.files.cancel_timers()
+        shutil.rmtree(self.root)
+
+    def test_migrate(self):
+        for code in ('abc', 'abd', 'xyz'):
+            self.files.save_file(code, code.encode(), meta())
+        self.files.cancel_timers()
+
+        # as if a move into the shard stopped between payload and metadata
+        os.makedirs(os.path.join(self.root, 'x', 'y'))
+        os.rename(self.files.path('xyz'), os.path.join(self.root, 'x', 'y', 'xyz'))
+
+        # files are served from wherever they are while they move
+        self.files = tmper.web.FileManager(self.root, depth=2)
+        self.assertEqual(self.files.used_codes, set(['abc', 'abd', 'xyz']))
+        self.assertEqual(self.files.checkout('abc')[0], b'abc')
+        self.assertEqual(self.files.migrate(), 0)
+
+        self.assertEqual(sorted(os.listdir(self.root)), ['a', 'x'])
+        self.assertEqual(sorted(os.listdir(self.files.shard('abc'))),
+            ['abc', 'abc.json', 'abd', 'abd.json'])
+        self.assertEqual(self.files.checkout('xyz')[0], b'xyz')
+        self.assertEqual(self.files.stray, {})
+
+
+class FileCacheTests(unittest.TestCase):
+    def test_budget_eviction(self):
+        c = tmper.cache.FileCache(budget=10, threshold=6)
+        c.put('a', b'aaaa', {})
+        c.put('b', b'bbbb', {})
+        c.put('x', b'x'*7, {})
+        self.assertEqual(list(c.entries), ['a', 'b'])
+
+        c.get('a')
+        c.put('c', b'cccc', {})
+        self.assertEqual(list(c.entries), ['a', 'c'])
+        self.assertEqual((c.size, c.evictions), (8, 1))
+
+    def test_file_manager_tier(self):
+        root = tempfile.mkdtemp()
+        files = tmper.web.FileManager(root, cache_size=100, cache_max_file=10)
+        try:
+            files.save_file('abc', b'data', meta(n=2))
+            files.save_file('big', b'x'*20, meta())
+
+            self.assertEqual(files.checkout('abc')[0], b'data')
+            self.assertTrue(files.consume('abc'))
+            self.assertEqual(files.lookup('abc').n, 1)
+            self.assertEqual(files.checkout('big')[0], b'x'*20)
+            self.assertEqual((files.cache.hits, files.cache.misses), (1, 1))
+
+            files.consume('abc')
+            files.checkin('abc')
+            self.assertNotIn('abc', files.cache.entries)
+        finally:
+            files.cancel_timers()
+            shutil.rmtree(root)
+
+
+class SessionTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_reordered_chunks_hash_without_read_back(self):
+        data = os.urandom(10000)
+        session = tmper.web.Session(self.root, len(data), 1000, {})
+        chunks = [data[i:i+1000] for i in range(0, len(data), 1000)]
+        fd = os.open(session.path, os.O_WRONLY)
+
+        for i in (2, 1, 3, 0, 5, 4, 6, 9, 8, 7):
+            hashes = None
+            if i == session.hashed:
+                hashes = {a: h.copy() for a, h in session.hashes.items()}
+                for h in hashes.values():
+                    h.update(chunks[i])
+            tmper.web.pwrite(fd, chunks[i], i*1000)
+            session.mark(i, hashes, chunks[i] if hashes is None else None)
+        os.close(fd)
+
+        self.assertEqual((session.hashed, session.early), (10, {}))
+        self.assertEqual(
+            session.digests()[tmper.web.DIGEST].hexdigest(),
+            hashlib.sha256(data).hexdigest()
+        )
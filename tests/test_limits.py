@@ -0,0 +1,31 @@
+import unittest
+
+import tmper.limits
+
+
+class LimitsTests(unittest.TestCase):
+    def test_bucket_burst(self):
+        limiter = tmper.limits.RateLimiter(rate=1e-3, burst=3)
+        self.assertEqual([limiter.take('a') for i in range(4)], [True]*3 + [False])
+        self.assertTrue(limiter.take('b'))
+        self.assertGreater(limiter.retry_after('a'), 0)
+
+    def test_sweep_idle(self):
+        limiter = tmper.limits.RateLimiter(rate=1e6, burst=1, size=2)
+        limiter.take('a')
+        limiter.take('b')
+        limiter.take('c')
+        self.assertEqual(set(limiter.buckets), set(['c']))
+
+    def test_admission(self):
+        adm = tmper.limits.Admission(client_rate=1e-3, client_burst=1, max_inflight=1)
+        self.assertTrue(adm.client('x'))
+        self.assertFalse(adm.client('x'))
+
+        self.assertTrue(adm.acquire())
+        self.assertFalse(adm.acquire())
+        adm.release()
+        self.assertTrue(adm.acquire())
+
+        self.assertEqual(adm.rejected['client'], 1)
+        self.assertEqual(adm.rejected['inflight'], 1)
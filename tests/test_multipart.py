@@ -0,0 +1,50 @@
+import io
+import unittest
+
+import tmper.multipart
+
+
+class Collect(object):
+    def __init__(self):
+        self.parts = []
+
+    def part_begin(self, part):
+        self.parts.append([part.name, part.filename, b''])
+
+    def part_data(self, data):
+        self.parts[-1][2] += data
+
+    def part_end(self):
+        self.parts[-1].append('end')
+
+
+class MultipartTests(unittest.TestCase):
+    def body(self):
+        ctype, gen = tmper.multipart.stream([
+            ('n', '2'),
+            ('filearg', ('a "b".txt', io.BytesIO(b'x\r\n--y' * 1000), 'text/plain')),
+            ('digest', lambda: 'late'),
+        ], chunk_size=333)
+        return tmper.multipart.boundary(ctype), b''.join(gen)
+
+    def test_roundtrip_any_split(self):
+        bound, body = self.body()
+        for size in (1, 7, 64, len(body)):
+            out = Collect()
+            parser = tmper.multipart.Parser(bound, out)
+            for i in range(0, len(body), size):
+                parser.feed(body[i:i+size])
+            parser.close()
+
+            self.assertEqual(out.parts, [
+                ['n', None, b'2', 'end'],
+                ['filearg', 'a "b".txt', b'x\r\n--y' * 1000, 'end'],
+                ['digest', None, b'late', 'end'],
+            ])
+
+    def test_truncated(self):
+        bound, body = self.body()
+        parser = tmper.multipart.Parser(bound, Collect())
+        parser.feed(body[:-10])
+        with self.assertRaises(ValueError):
+            parser.close()
@@ -0,0 +1,64 @@
+import os
+import json
+import shutil
+import datetime
+import unittest
+import tempfile
+
+import tmper.web
+from tmper.record import Meta, epoch
+
+KEY = '$2b$12$' + 'x'*53
+
+
+class MetaTests(unittest.TestCase):
+    def test_roundtrip(self):
+        m = Meta('report.pdf', 'application/pdf', 1700000000, 3, KEY, 'ab'*32, 'sha-256')
+        self.assertEqual(Meta.decode(json.loads(json.dumps(m.encode()))), m)
+        self.assertEqual(m.filename, 'report.pdf')
+        self.assertEqual(m.key, KEY.encode('utf-8'))
+        self.assertEqual(m.digest, 'ab'*32)
+        self.assertEqual((m.expires, m.n), (1700000000, 3))
+
+    def test_defaults(self):
+        m = Meta.decode(Meta().encode())
+        self.assertEqual((m.filename, m.key, m.digest, m.digest_algo), ('upload', None, None, None))
+
+    def test_replace(self):
+        m = Meta('a.txt', n=2, key=KEY)
+        r = m.replace(n=1)
+        self.assertEqual((m.n, r.n), (2, 1))
+        self.assertEqual((r.filename, r.key), ('a.txt', m.key))
+
+    def test_legacy_dict(self):
+        time = datetime.datetime(2030, 1, 2, 3, 4, 5)
+        m = Meta.decode({
+            'filename': 'old.txt', 'content_type': 'text/plain', 'n': 2,
+            'key': None, 'time': time.isoformat(), 'extra': 'ignored'
+        })
+        self.assertEqual(m, Meta('old.txt', 'text/plain', epoch(time), 2))
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            Meta.decode([99] + Meta().encode()[1:])
+
+
+class LegacyFileTests(unittest.TestCase):
+    def test_reads_legacy_sidecar(self):
+        root = tempfile.mkdtemp()
+        try:
+            files = tmper.web.FileManager(root)
+            os.makedirs(files.shard('abc'))
+            time = datetime.datetime.now() + datetime.timedelta(minutes=10)
+            with open(files.path('abc'), 'wb') as f:
+                f.write(b'data')
+            with open(files.pathj('abc'), 'w') as f:
+                json.dump({'n': 1, 'key': None, 'time': time.isoformat(),
+                    'filename': 'old.txt'}, f)
+
+            files.init()
+            data, m = files.open_file('abc')
+            self.assertEqual((data, m.filename, m.expires), (b'data', 'old.txt', epoch(time)))
+            files.cancel_timers()
+        finally:
+            shutil.rmtree(root)
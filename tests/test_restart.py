@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import signal
+import shutil
+import socket
+import tempfile
+import unittest
+import subprocess
+
+import requests
+
+import tmper.util
+
+ADDR = '127.0.0.1'
+PORT = 3337
+URL = 'http://{}:{}/'.format(ADDR, PORT)
+
+SERVE = 'import tmper.web; tmper.web.serve({!r}, {}, {!r}, drain_timeout={}, restart={!r})'
+
+# the process started on SIGHUP notes its pid, so that it can be stopped
+RESTART = (
+    'import os; open({!r}, "w").write(str(os.getpid())); '
+    'import tmper.web; tmper.web.serve({!r}, {}, {!r})'
+)
+
+def wait_for(check, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        if check():
+            return True
+        time.sleep(0.1)
+    return False
+
+def up():
+    try:
+        return requests.get(URL).status_code == 200
+    except IOError:
+        return False
+
+
+class RestartTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pidfile = os.path.join(self.root, 'restart.pid')
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        if os.path.exists(self.pidfile):
+            try:
+                os.kill(int(open(self.pidfile).read()), signal.SIGKILL)
+            except OSError:
+                pass
+        shutil.rmtree(self.root)
+
+    def serve(self, drain_timeout=30, restart=None):
+        code = SERVE.format(os.path.join(self.root, 'files'), PORT, ADDR, drain_timeout, restart)
+        proc = subprocess.Popen([sys.executable, '-c', code], stderr=subprocess.DEVNULL)
+        self.procs.append(proc)
+        self.assertTrue(wait_for(up))
+        return proc
+
+    def upload(self, data, **kwargs):
+        path = os.path.join(self.root, 'upload')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return tmper.util.upload(URL, path, **kwargs)
+
+    def stalled_download(self, code):
+        """ A download whose client reads nothing past the headers """
+        sock = socket.create_connection((ADDR, PORT))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 12)
+        sock.sendall('GET /{} HTTP/1.1\r\nHost: x\r\nUser-Agent: tmper\r\n\r\n'.format(code).encode())
+        head = b''
+        while b'\r\n\r\n' not in head:
+            head += sock.recv(1)
+        return sock
+
+    def test_terminate_idle(self):
+        proc = self.serve()
+        proc.send_signal(signal.SIGTERM)
+        self.assertEqual(proc.wait(5), 0)
+
+    def test_drain_finishes_download(self):
+        data = os.urandom(1 << 25)
+        proc = self.serve()
+        code = self.upload(data)
+
+        sock = self.stalled_download(code)
+        proc.send_signal(signal.SIGTERM)
+        self.assertTrue(wait_for(lambda: not up()))
+        self.assertIsNone(proc.poll())
+
+        body = b''
+        while len(body) < len(data):
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            body += chunk
+        sock.close()
+
+        self.assertEqual(body, data)
+        self.assertEqual(proc.wait(5), 0)
+
+    def test_deadline_gives_download_back(self):
+        data = os.urandom(1 << 25)
+        proc = self.serve(drain_timeout=0.5)
+        code = self.upload(data)
+
+        sock = self.stalled_download(code)
+        proc.send_signal(signal.SIGTERM)
+        self.assertEqual(proc.wait(5), 0)
+        sock.close()
+
+        self.serve()
+        self.assertEqual(requests.get(URL + code).content, data)
+
+    def test_handoff(self):
+        restart = [sys.executable, '-c', RESTART.format(
+            self.pidfile, os.path.join(self.root, 'files'), PORT, ADDR
+        )]
+        proc = self.serve(restart=restart)
+        code = self.upload(b'handed over')
+
+        proc.send_signal(signal.SIGHUP)
+        failures = 0
+        while proc.poll() is None:
+            try:
+                requests.get(URL)
+            except IOError:
+                failures += 1
+
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(failures, 0)
+        self.assertTrue(os.path.exists(self.pidfile))
+        self.assertEqual(requests.get(URL + code).content, b'handed over')
@@ -1,6 +1,9 @@
 import os
+import sys
 import time
+import base64
 import shutil
+import hashlib
 import requests
 import unittest
 import multiprocessing
@@ -118,3 +121,101 @@ class FlaskRoutesTests(unittest.TestCase):
         #self.assertEqual(s, status.HTTP_200_OK)
         #self.assertEqual(s, status.HTTP_406_NOT_ACCEPTABLE)
         #self.assertTrue('reason' in r)
+
+    def test_06_binary_roundtrip(self):
+        data = os.urandom(3 << 20)
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.bin') as f:
+            f.write(data)
+            f.flush()
+            code = tmper.util.upload(URL, f.name)
+
+        filename = tmper.util.download(URL, code)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_07_digest_header(self):
+        code = self.upload()
+
+        response = requests.get(urljoin(URL, code))
+        expected = base64.b64encode(hashlib.sha256(lorem.encode()).digest())
+        self.assertEqual(response.headers['Digest'], 'sha-256=' + expected.decode())
+
+    def test_08_digest_mismatch(self):
+        response = requests.post(
+            URL, data={'digest': 'sha-256=' + base64.b64encode(b'0'*32).decode()},
+            files={'filearg': ('lorem.txt', lorem)}, headers={'User-Agent': 'tmper'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_09_stream_stdin(self):
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'tmper', 'u', '-u', URL, '--as', 'lorem.txt', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        out, err = proc.communicate(lorem.encode())
+        self.assertEqual(proc.returncode, 0)
+
+        code = out.decode().strip()
+        response = requests.get(urljoin(URL, code))
+        self.assertEqual(response.content.decode('utf-8'), lorem)
+        self.assertIn('lorem.txt', response.headers['Content-Disposition'])
+
+
+    def test_10_resumable(self):
+        with self.tempfile() as f:
+            code = tmper.util.upload(URL, f.name, resumable=True)
+        out = self.download(code)
+        self.assertEqual(out, lorem)
+
+    def test_11_resumable_out_of_order(self):
+        data = os.urandom(200000)
+        chunk = 1 << 16
+        base = urljoin(URL, 'upload')
+
+        session = requests.post(base, data={'size': len(data), 'chunk': chunk}).json()
+        url = '{}/{}'.format(base, session['id'])
+        self.assertEqual(session['count'], 4)
+
+        for i in (3, 1, 1, 0):
+            r = requests.put('{}/{}'.format(url, i), data=data[i*chunk:(i+1)*chunk])
+            self.assertEqual(r.status_code, 200)
+
+        self.assertEqual(requests.get(url).json()['received'], [0, 1, 3])
+        self.assertEqual(requests.post(url).status_code, 409)
+
+        requests.put('{}/{}'.format(url, 2), data=data[2*chunk:3*chunk])
+        code = requests.post(url, data={'codeonly': 1}).text
+
+        response = requests.get(urljoin(URL, code))
+        self.assertEqual(response.content, data)
+        self.assertEqual(
+            response.headers['Digest'],
+            'sha-256=' + base64.b64encode(hashlib.sha256(data).digest()).decode()
+        )
+
+    def test_12_relay_live(self):
+        data = os.urandom(4 << 20)
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.bin') as f:
+            f.write(data)
+            f.flush()
+
+            # the code is printed before the upload, which waits for us
+            proc = subprocess.Popen(
+                [sys.executable, '-m', 'tmper', 'u', '-u', URL, '--live', f.name],
+                stdout=subprocess.PIPE
+            )
+            code = proc.stdout.readline().decode().strip()
+
+            response = requests.get(urljoin(URL, code))
+            proc.communicate()
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(response.content, data)
+            self.assertEqual(response.headers['Content-Length'], str(len(data)))
+            self.assertEqual(requests.get(urljoin(URL, code)).status_code, 404)
+
+    def test_13_relay_spool(self):
+        with self.tempfile() as f:
+            code = tmper.util.upload_relay(URL, f.name, password='pw', spool=True)
+
+        self.assertEqual(requests.get(urljoin(URL, code)).status_code, 404)
+        self.assertEqual(self.download(code, password='pw'), lorem)
@@ -1 +1,2 @@
-__all__ = ['web', 'util']
+__all__ = ['web', 'util', 'client']
+__version__ = '0.5.7'
@@ -5,11 +5,11 @@ import os
 import sys
 import argparse
 
-import tmper.web
-import tmper.util
+import tmper.digest
+from tmper import __version__
 
-import pkg_resources
-__version__ = pkg_resources.require("tmper")[0].version
+# the client and server modules are imported by the action that needs them,
+# since importing the server (tornado, bcrypt, ...) dominates client startup
 
 #=============================================================================
 # command line parsing and main
@@ -106,6 +106,37 @@ def main():
         help="port on which to run the server")
     p_serve.add_argument("-r", "--root", type=str, default=root,
         help="directory in which to store the uploaded files")
+    p_serve.add_argument("-g", "--digest", type=str, default=tmper.digest.DEFAULT,
+        choices=sorted(tmper.digest.ALGORITHMS),
+        help="checksum algorithm used to verify transferred files")
+    p_serve.add_argument("-s", "--durability", type=str, default='none',
+        choices=['none', 'complete', 'batch'],
+        help="when to fsync saved files: never, on every write or in batches")
+    p_serve.add_argument("-f", "--fsync-ms", type=float, default=50,
+        help="interval between batched fsyncs in milliseconds")
+    p_serve.add_argument("-l", "--rate", type=float, default=20,
+        help="requests per second allowed from each client (bursts of twice that)")
+    p_serve.add_argument("-m", "--max-inflight", type=int, default=64,
+        help="number of uploads and downloads allowed at once (0 for no limit)")
+    p_serve.add_argument("-c", "--cache-mb", type=float, default=0,
+        help="memory in MB used to cache small files (0 disables the cache)")
+    p_serve.add_argument("-k", "--cache-max-kb", type=float, default=1024,
+        help="largest file in kB which is kept in the cache")
+    p_serve.add_argument("-d", "--shard-depth", type=int, default=1,
+        help="levels of subdirectories, by code prefix, in which files are "
+             "stored (existing files are moved over while serving)")
+    p_serve.add_argument("-x", "--cluster", type=str, default='',
+        help="json file listing the nodes of a cluster sharing the code space")
+    p_serve.add_argument("-n", "--node", type=str, default='',
+        help="name of this server among the nodes of the cluster")
+    p_serve.add_argument("-e", "--profiling", action='store_true', default=False,
+        help="serve /debug/profile?seconds=N (sampled stacks) and "
+             "/debug/timings (phase timings of recent requests)")
+    p_serve.add_argument("-t", "--server-timing", action='store_true', default=False,
+        help="send the phase timings of each transfer as a Server-Timing header")
+    p_serve.add_argument("-w", "--drain-timeout", type=float, default=30,
+        help="seconds to let transfers finish on SIGTERM before stopping "
+             "(SIGHUP hands the port to a new server, then does the same)")
 
     # custom arguments for upload action
     p_upload.add_argument("-n", "--num", type=int, default=1,
@@ -117,7 +148,22 @@ def main():
     p_upload.add_argument("-d", "--progress", dest='progress',
         action='store_true', default=False,
         help="show progress bar while transferring files")
-    p_upload.add_argument("filename", type=str, help="name of file to upload")
+    p_upload.add_argument("-r", "--resumable", dest='resumable',
+        action='store_true', default=None,
+        help="send the file in chunks which are retried if they fail "
+             "(default for files over 64MB)")
+    p_upload.add_argument("-a", "--as", dest='name', type=str, default='',
+        help="filename given to the downloader (default is the uploaded name)")
+    p_upload.add_argument("-l", "--live", dest='live',
+        action='store_true', default=False,
+        help="relay the file to its (single) downloader as it is sent "
+             "instead of storing it, the code is printed right away")
+    p_upload.add_argument("-s", "--spool", dest='spool',
+        action='store_true', default=False,
+        help="with --live, let the server hold the file until the "
+             "downloader arrives rather than waiting for them")
+    p_upload.add_argument("filename", type=str,
+        help="name of file to upload, '-' to stream from stdin")
 
     # custom arguments for download action
     p_download.add_argument(
@@ -136,18 +182,35 @@ def main():
     action = args.get('action')
 
     if action == 'serve':
+        from tmper import web
+        from tmper import cluster
         try:
-            tmper.web.serve(
+            nodes = None
+            if args.get('cluster'):
+                nodes = cluster.load(args.get('cluster'), args.get('node'))
+
+            web.serve(
                 root=args.get('root'), port=args.get('port'),
-                addr=args.get('addr')
+                addr=args.get('addr'), digest_algo=args.get('digest'),
+                durability=args.get('durability'),
+                fsync_interval=args.get('fsync_ms')/1e3,
+                client_rate=(args.get('rate'), 2*args.get('rate')),
+                max_inflight=args.get('max_inflight'),
+                cache_size=int(args.get('cache_mb')*(1 << 20)),
+                cache_max_file=int(args.get('cache_max_kb')*(1 << 10)),
+                shard_depth=args.get('shard_depth'), cluster=nodes,
+                profiling=args.get('profiling'),
+                timing_header=args.get('server_timing'),
+                drain_timeout=args.get('drain_timeout')
             )
         except Exception as e:
             print(e, file=sys.stderr)
             sys.exit(1)
 
     elif action == 'download':
+        from tmper import util
         try:
-            filename = tmper.util.download(
+            filename = util.download(
                 args.get('url'), args.get('code'),
                 password=args.get('pass'), browser=args.get('browser'),
                 disp=args.get('progress')
@@ -157,13 +220,33 @@ def main():
             print(e, file=sys.stderr)
             sys.exit(1)
 
+    elif action == 'upload' and args.get('live'):
+        from tmper import util
+
+        def announce(code):
+            print(code)
+            sys.stdout.flush()
+
+        try:
+            util.upload_relay(
+                args.get('url'), args.get('filename'),
+                code=args.get('code'), password=args.get('pass'),
+                name=args.get('name'), spool=args.get('spool'),
+                announce=announce
+            )
+        except Exception as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
     elif action == 'upload':
+        from tmper import util
         try:
-            code = tmper.util.upload(
+            code = util.upload(
                 args.get('url'), args.get('filename'),
                 code=args.get('code'), num=args.get('num'),
                 password=args.get('pass'), time=args.get('time'),
-                disp=args.get('progress')
+                disp=args.get('progress'), name=args.get('name'),
+                resumable=args.get('resumable')
             )
             print(code)
         except Exception as e:
@@ -171,7 +254,8 @@ def main():
             sys.exit(1)
 
     elif action == 'conf':
-        tmper.util.conf(
+        from tmper import util
+        util.conf(
             url=args.get('url'), password=args.get('pass')
         )
 
@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+import collections
+
+#=============================================================================
+# in-memory tier for small files, in front of the FileManager's disk storage
+#=============================================================================
+class FileCache(object):
+    """
+    Least recently used cache of (payload, metadata) pairs, bounded by the
+    total payload size `budget` in bytes. Only payloads of at most
+    `threshold` bytes are kept, larger ones always come from disk. Metadata
+    records are immutable, so they are kept and returned as given.
+    """
+    def __init__(self, budget, threshold):
+        self.budget = budget
+        self.threshold = threshold
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, name, data, meta):
+        """ Cache a payload if it is small enough, evicting to fit """
+        self.discard(name)
+        if len(data) > min(self.threshold, self.budget):
+            return
+
+        self.entries[name] = (data, meta)
+        self.size += len(data)
+
+        while self.size > self.budget:
+            old, (d, m) = self.entries.popitem(last=False)
+            self.size -= len(d)
+            self.evictions += 1
+
+    def get(self, name):
+        """ Returns (data, meta) or (None, None), counting hits and misses """
+        if name not in self.entries:
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        self.entries.move_to_end(name)
+        return self.entries[name]
+
+    def meta(self, name):
+        """ Cached metadata of a file, without touching the counters """
+        if name in self.entries:
+            return self.entries[name][1]
+        return None
+
+    def update_meta(self, name, meta):
+        if name in self.entries:
+            self.entries[name] = (self.entries[name][0], meta)
+
+    def discard(self, name):
+        if name in self.entries:
+            data, meta = self.entries.pop(name)
+            self.size -= len(data)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries), 'bytes': self.size,
+            'budget': self.budget, 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
@@ -0,0 +1,448 @@
+from __future__ import print_function
+
+import os
+import re
+import ssl
+import sys
+import time
+import uuid
+import inspect
+import mimetypes
+import collections
+
+import requests
+from tornado import httputil, iostream, locks, tcpclient, http1connection
+
+try:
+    import urlparse
+    from urllib import urlencode
+except ImportError:
+    # Python3 imports
+    import urllib.parse as urlparse
+    from urllib.parse import urlencode
+
+from tmper import __version__
+from tmper import digest
+from tmper import multipart
+from tmper import util
+
+#=============================================================================
+# client objects for programs, which read the configuration once and reuse
+# their connections: a blocking one on requests and an asyncio one (Python
+# 3.5+) speaking http/1.1 through tornado, so that many transfers can share
+# one event loop without a thread each
+#=============================================================================
+# read size of files and of downloads streamed into sinks
+CHUNK_SIZE = 1 << 16
+
+# most connections an AsyncClient has open at once, more requests wait
+MAX_CONNECTIONS = 128
+
+# idle connections older than this are not reused, well within the server's
+# own idle timeout, so that a reused connection is rarely found closed
+IDLE_TIMEOUT = 30
+
+# seconds to connect and to receive the response headers, bodies are
+# streamed and so take as long as they take
+TIMEOUT = 60
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+def chunks(source):
+    """ Bytes, a file or an iterable of bytes as an iterable of bytes """
+    if isinstance(source, bytes):
+        return [source]
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(CHUNK_SIZE), b'')
+    return source
+
+
+async def achunks(source):
+    """ As chunks, but also taking an async iterable of bytes """
+    if hasattr(source, '__aiter__'):
+        async for chunk in source:
+            yield chunk
+    else:
+        for chunk in chunks(source):
+            yield chunk
+
+
+class Download(object):
+    """
+    A downloaded file: its name, type and digest from the response headers,
+    and its body unless that was written to a sink
+    """
+    def __init__(self, headers, body=None, size=0):
+        match = re.match('.*filename="(.*)"$', headers.get('Content-Disposition', ''))
+        self.filename = os.path.basename(match.groups()[0]) if match else 'upload'
+        self.content_type = headers.get('Content-Type', 'application/unknown')
+        self.digest_algo, self.digest = digest.parse(headers.get('Digest'))
+        self.body = body
+        self.size = size
+
+
+class BaseClient(object):
+    """
+    The server's url and the password of uploads and downloads, which
+    default to those set with `tmper conf`
+    """
+    def __init__(self, url=None, password=None):
+        conf = util.conf_load()
+        self.url = url or conf.get('url')
+        self.password = password or conf.get('pass') or ''
+        self.headers = {'User-Agent': 'tmper/{}'.format(__version__)}
+
+        if not self.url:
+            raise AssertionError("No URL provided! Provide one or set on via conf.")
+
+    def args(self, password=None, **kwargs):
+        out = dict(kwargs, key=self.password if password is None else password)
+        return {k: v for k, v in out.items() if v}
+
+    def form(self, name, content_type):
+        """
+        Content type, head and tail of a multipart upload of one file, where
+        the tail is a function of the file's hasher, so that the digest of
+        the file can be sent after it. The other arguments go in the query.
+        """
+        bound = uuid.uuid4().hex
+        content_type = content_type or mimetypes.guess_type(name)[0] or 'application/unknown'
+        head = multipart.head(bound, 'filearg', name, content_type)
+
+        def tail(hasher):
+            value = digest.header(digest.DEFAULT, hasher.hexdigest())
+            return b''.join([
+                b'\r\n', multipart.head(bound, 'digest'), multipart.tobytes(value),
+                b'\r\n', multipart.end(bound)
+            ])
+
+        return 'multipart/form-data; boundary={}'.format(bound), head, tail
+
+    def upload_url(self, base, code, num, time, password):
+        args = self.args(password, n=str(num) if num != 1 else '', time=time, codeonly=1)
+        return '{}?{}'.format(urlparse.urljoin(base, code), urlencode(args))
+
+    def download_url(self, code, password):
+        args = self.args(password)
+        query = '?' + urlencode(args) if args else ''
+        return '{}{}'.format(urlparse.urljoin(self.url, code), query)
+
+    @staticmethod
+    def owner(url, code, response):
+        """ The base URL of the node owning code, per a HEAD of url+code """
+        location = response.headers.get('Location')
+        if response.status_code in REDIRECTS and location and code in location:
+            return location[:location.rindex(code)]
+        return url
+
+
+class Client(BaseClient):
+    """
+    Blocking client keeping one requests session, and so a pool of
+    connections, for all of its transfers
+    """
+    def __init__(self, url=None, password=None, timeout=TIMEOUT):
+        super(Client, self).__init__(url, password)
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.http.headers.update(self.headers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    def locate(self, code):
+        r = self.http.head(
+            urlparse.urljoin(self.url, code), allow_redirects=False, timeout=self.timeout
+        )
+        return self.owner(self.url, code, r)
+
+    def upload(self, source, name='upload', content_type=None, num=1, time='',
+            code='', password=None):
+        """
+        Upload source, which is bytes, a file opened for binary reading or an
+        iterable of bytes, as a file called name. Returns its code.
+        """
+        base = self.locate(code) if code else self.url
+        ctype, head, tail = self.form(name, content_type)
+        hasher = digest.new()
+
+        def body():
+            yield head
+            for chunk in chunks(source):
+                hasher.update(chunk)
+                yield chunk
+            yield tail(hasher)
+
+        r = self.http.post(
+            self.upload_url(base, code, num, time, password), data=body(),
+            headers={'Content-Type': ctype}, timeout=self.timeout
+        )
+        return util.response_code(r)
+
+    def download(self, code, sink=None, password=None):
+        """
+        Download a file, writing its body to sink (anything with a write
+        method) if given, and checking it against the server's digest.
+        Returns a Download, with the body if there was no sink.
+        """
+        r = self.http.get(
+            self.download_url(code, password), stream=True, timeout=self.timeout
+        )
+        if r.status_code != 200:
+            raise KeyError("Code '{}' not found at '{}', '{}'".format(
+                code, self.url, r.content.decode('utf-8')
+            ))
+
+        out = Download(r.headers)
+        hasher = digest.new(out.digest_algo) if out.digest_algo else None
+        body = []
+
+        with r:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                if hasher:
+                    hasher.update(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                else:
+                    body.append(chunk)
+                out.size += len(chunk)
+
+        if hasher and hasher.hexdigest() != out.digest:
+            raise IOError("Code '{}' failed {} verification".format(code, out.digest_algo))
+        out.body = None if sink is not None else b''.join(body)
+        return out
+
+
+class Response(httputil.HTTPMessageDelegate):
+    """
+    Reads a response, the body of a 200 into sink if there is one. The
+    body of a 200 is hashed as it arrives when the server sent its digest.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.start_line = None
+        self.headers = None
+        self.hasher = None
+        self.chunks = []
+        self.size = 0
+        self.done = False
+
+    @property
+    def status_code(self):
+        return self.start_line.code if self.start_line else None
+
+    @property
+    def body(self):
+        return b''.join(self.chunks)
+
+    def headers_received(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers
+
+        algo, hexdigest = digest.parse(headers.get('Digest'))
+        if algo and start_line.code == 200:
+            self.hasher = digest.new(algo)
+
+    def data_received(self, chunk):
+        self.size += len(chunk)
+        if self.hasher:
+            self.hasher.update(chunk)
+
+        # the connection waits on what the sink returns, which holds off
+        # reading the socket while a slow sink catches up
+        if self.sink is not None and self.status_code == 200:
+            return self.sink(chunk)
+        self.chunks.append(chunk)
+
+    def finish(self):
+        self.done = True
+
+    def on_connection_close(self):
+        pass
+
+    def reusable(self):
+        return (
+            self.done and self.start_line.version == 'HTTP/1.1' and
+            self.headers.get('Connection', '').lower() != 'close'
+        )
+
+
+class Pool(object):
+    """ Idle keep-alive connections of each (scheme, host, port) """
+    def __init__(self, timeout=TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle = collections.defaultdict(list)
+        self.tcp = tcpclient.TCPClient()
+
+    async def get(self, key):
+        """ A connection to key and whether it is a reused one """
+        idle = self.idle[key]
+        while idle:
+            stream, since = idle.pop()
+            if not stream.closed() and time.time() - since < self.idle_timeout:
+                return stream, True
+            stream.close()
+
+        scheme, host, port = key
+        stream = await self.tcp.connect(
+            host, port, timeout=self.timeout,
+            ssl_options=ssl.create_default_context() if scheme == 'https' else None
+        )
+        stream.set_nodelay(True)
+        return stream, False
+
+    def put(self, key, stream):
+        self.idle[key].append((stream, time.time()))
+
+    def close(self):
+        for idle in self.idle.values():
+            for stream, since in idle:
+                stream.close()
+        self.idle.clear()
+        self.tcp.close()
+
+
+class AsyncClient(BaseClient):
+    """
+    Asyncio client, whose transfers all share a pool of at most
+    max_connections keep-alive connections. Uploads read from async
+    iterators and downloads write to async sinks, both with backpressure,
+    so a transfer only holds one chunk in memory.
+    """
+    def __init__(self, url=None, password=None, max_connections=MAX_CONNECTIONS,
+            timeout=TIMEOUT):
+        super(AsyncClient, self).__init__(url, password)
+        self.slots = locks.Semaphore(max_connections)
+        self.pool = Pool(timeout)
+        self.params = http1connection.HTTP1ConnectionParameters(
+            header_timeout=timeout, max_body_size=sys.maxsize, chunk_size=CHUNK_SIZE
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    async def request(self, method, url, headers=None, body=None, sink=None):
+        """
+        Send a request, body being None, bytes or an async iterable of
+        bytes, and read its response, a 200's body going into the coroutine
+        function sink if given. A GET or HEAD is retried on a new connection
+        if the reused one it was sent on turns out to be closed.
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        hdrs = httputil.HTTPHeaders(self.headers)
+        hdrs['Host'] = parts.netloc
+        hdrs.update(headers or {})
+        if body is None or isinstance(body, bytes):
+            if body or method in ('POST', 'PUT'):
+                hdrs['Content-Length'] = str(len(body or b''))
+
+        async with self.slots:
+            while True:
+                stream, reused = await self.pool.get(key)
+                response = Response(sink)
+                kept = False
+                try:
+                    conn = http1connection.HTTP1Connection(stream, True, self.params)
+                    await self.send(conn, method, path, hdrs, body)
+                    await conn.read_response(response)
+                    if response.done:
+                        kept = response.reusable() and not stream.closed()
+                        return response
+                except (iostream.StreamClosedError, httputil.HTTPInputError):
+                    pass
+                finally:
+                    if kept:
+                        self.pool.put(key, stream)
+                    else:
+                        stream.close()
+
+                if not (reused and response.start_line is None and method in ('GET', 'HEAD')):
+                    raise IOError('Connection to {} lost'.format(parts.netloc))
+
+    async def send(self, conn, method, path, headers, body):
+        start = httputil.RequestStartLine(method, path, 'HTTP/1.1')
+        if body is None or isinstance(body, bytes):
+            await conn.write_headers(start, headers, body or None)
+        else:
+            await conn.write_headers(start, headers)
+            async for chunk in body:
+                await conn.write(chunk)
+        conn.finish()
+
+    async def locate(self, code):
+        r = await self.request('HEAD', urlparse.urljoin(self.url, code))
+        return self.owner(self.url, code, r)
+
+    async def upload(self, source, name='upload', content_type=None, num=1,
+            time='', code='', password=None):
+        """
+        Upload source, which is bytes, a file opened for binary reading or
+        a (async) iterable of bytes, as a file called name. Returns its code.
+        """
+        base = await self.locate(code) if code else self.url
+        ctype, head, tail = self.form(name, content_type)
+        hasher = digest.new()
+
+        async def body():
+            yield head
+            async for chunk in achunks(source):
+                hasher.update(chunk)
+                yield chunk
+            yield tail(hasher)
+
+        r = await self.request(
+            'POST', self.upload_url(base, code, num, time, password),
+            headers={'Content-Type': ctype}, body=body()
+        )
+        if r.status_code != 200:
+            raise IOError(r.body.decode('utf-8'))
+        return r.body.decode('utf-8')
+
+    async def download(self, code, sink=None, password=None):
+        """
+        Download a file, giving its body in chunks to sink if given, which
+        is a coroutine function or has a write method (whose result is
+        awaited when it is awaitable), and checking it against the server's
+        digest. Returns a Download, with the body if there was no sink.
+        """
+        write = getattr(sink, 'write', sink)
+
+        async def receive(chunk):
+            result = write(chunk)
+            if inspect.isawaitable(result):
+                await result
+
+        # in a cluster in redirect mode, the node asked may send us on
+        url = self.download_url(code, password)
+        for hop in range(len(REDIRECTS)):
+            r = await self.request('GET', url, sink=receive if sink is not None else None)
+            if r.status_code not in REDIRECTS or 'Location' not in r.headers:
+                break
+            url = urlparse.urljoin(url, r.headers['Location'])
+
+        if r.status_code != 200:
+            raise KeyError("Code '{}' not found at '{}', '{}'".format(
+                code, self.url, r.body.decode('utf-8')
+            ))
+
+        out = Download(r.headers, None if sink is not None else r.body, r.size)
+        if r.hasher and r.hasher.hexdigest() != out.digest:
+            raise IOError("Code '{}' failed {} verification".format(code, out.digest_algo))
+        return out
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import json
+import bisect
+import hashlib
+
+#=============================================================================
+# several servers sharing one code space, each owning a part of it
+#=============================================================================
+# points per node on the ring, more spreads the prefixes more evenly
+VNODES = 64
+
+# what a node does with a download of a code another node owns
+FORWARD_MODES = ['proxy', 'redirect']
+
+def hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class Ring(object):
+    """
+    Consistent hash ring of node names, so that adding or removing a node
+    only moves the keys of the ring segments next to its points
+    """
+    def __init__(self, nodes, vnodes=VNODES):
+        self.points = sorted(
+            (hash_key('{}#{}'.format(node, i)), node)
+            for node in nodes for i in range(vnodes)
+        )
+        self.hashes = [h for h, node in self.points]
+
+    def owner(self, key):
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class Cluster(object):
+    """
+    Static membership of a cluster, seen from node `name`. nodes maps node
+    names to their base URLs. Codes are placed on the ring by their first
+    `prefix` characters, so a node owns whole prefixes of the code space.
+    """
+    def __init__(self, nodes, name, prefix=1, vnodes=VNODES, forward='proxy'):
+        if name not in nodes:
+            raise ValueError("Node '{}' is not in the cluster".format(name))
+        if forward not in FORWARD_MODES:
+            raise ValueError("Unknown forward mode '{}'".format(forward))
+
+        self.nodes = nodes
+        self.name = name
+        self.prefix = prefix
+        self.forward = forward
+        self.ring = Ring(sorted(nodes), vnodes)
+
+    def owner(self, code):
+        return self.ring.owner(code[:self.prefix])
+
+    def owns(self, code):
+        return self.owner(code) == self.name
+
+    def url(self, code, uri):
+        """ The URL of uri (path and query) on the owner of code """
+        return self.nodes[self.owner(code)].rstrip('/') + uri
+
+
+def load(path, name):
+    """
+    Read a cluster from a json file of the form
+
+        {"nodes": {"a": "http://10.0.0.1:8888", "b": "http://10.0.0.2:8888"},
+         "prefix": 1, "forward": "proxy"}
+
+    as seen from the node called name
+    """
+    with open(path) as f:
+        conf = json.load(f)
+
+    return Cluster(
+        conf['nodes'], name, prefix=conf.get('prefix', 1),
+        vnodes=conf.get('vnodes', VNODES), forward=conf.get('forward', 'proxy')
+    )
@@ -0,0 +1,109 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+import threading
+import collections
+
+clock = getattr(time, 'perf_counter', time.time)
+
+#=============================================================================
+# cheap enough to leave on: a sampling profiler and per request phase timings
+#=============================================================================
+INTERVAL = 0.005
+
+class Sampler(object):
+    """
+    Samples the stack of the thread `ident` every `interval` seconds from a
+    thread of its own, counting how often each stack is seen. The target is
+    never paused or traced, so it only pays for the GIL the sampler takes.
+    """
+    def __init__(self, ident, interval=INTERVAL):
+        self.ident = ident
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.ident)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        """ One 'outer;...;inner count' line per stack, as flame graphs take """
+        return ''.join(
+            '{} {}\n'.format(stack, n) for stack, n in sorted(self.stacks.items())
+        )
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Timing(object):
+    """ Durations of the consecutive named phases of one request """
+    __slots__ = ['start', 'stamp', 'phases']
+
+    def __init__(self):
+        self.start = self.stamp = clock()
+        self.phases = []
+
+    def mark(self, name):
+        """ End the current phase, which is called name """
+        now = clock()
+        self.phases.append((name, now - self.stamp))
+        self.stamp = now
+
+    def total(self):
+        return clock() - self.start
+
+    def header(self):
+        """ The phases as a Server-Timing header value, in milliseconds """
+        return ', '.join('{};dur={:.3f}'.format(n, 1e3*d) for n, d in self.phases)
+
+
+class Timings(object):
+    """ Ring buffer of the timings of the last `size` requests """
+    def __init__(self, size=1000):
+        self.entries = collections.deque(maxlen=size)
+
+    def record(self, route, status, timing):
+        self.entries.append({
+            'route': route, 'status': status, 'total': timing.total(),
+            'phases': timing.phases,
+        })
+
+    def summary(self):
+        """ Count, mean, median and 99th percentile in ms of each phase """
+        durations = collections.defaultdict(list)
+        for entry in list(self.entries):
+            durations['total'].append(entry['total'])
+            for name, d in entry['phases']:
+                durations[name].append(d)
+
+        out = {}
+        for name, ds in durations.items():
+            ds.sort()
+            out[name] = {
+                'count': len(ds), 'mean': 1e3*sum(ds)/len(ds),
+                'p50': 1e3*ds[len(ds)//2], 'p99': 1e3*ds[min(len(ds)-1, 99*len(ds)//100)],
+            }
+        return out
@@ -0,0 +1,52 @@
+from __future__ import print_function
+
+import base64
+import binascii
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+#=============================================================================
+# content digests shared by the server and the command line client
+#=============================================================================
+# names follow the http digest algorithm registry where one exists
+ALGORITHMS = {'sha-256': hashlib.sha256}
+
+if hasattr(hashlib, 'blake2b'):
+    ALGORITHMS['blake2b'] = hashlib.blake2b
+
+if xxhash is not None:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+
+DEFAULT = 'sha-256'
+
+def tostring(obj):
+    if isinstance(obj, bytes):
+        return obj.decode()
+    return obj
+
+def new(algo=DEFAULT):
+    """ Create an incremental hasher for the named algorithm """
+    if algo not in ALGORITHMS:
+        raise ValueError("Unsupported digest '{}'".format(algo))
+    return ALGORITHMS[algo]()
+
+def header(algo, hexdigest):
+    """ Format a `Digest` header value, i.e. 'sha-256=<base64>' """
+    raw = base64.b64encode(binascii.unhexlify(hexdigest))
+    return '{}={}'.format(algo, raw.decode('ascii'))
+
+def parse(value):
+    """
+    Parse a `Digest` header value into (algo, hexdigest), picking the first
+    algorithm we know about. Returns (None, None) if there is none.
+    """
+    for item in (value or '').split(','):
+        algo, _, raw = item.strip().partition('=')
+        algo = algo.lower()
+        if algo in ALGORITHMS and raw:
+            return algo, tostring(binascii.hexlify(base64.b64decode(raw)))
+    return None, None
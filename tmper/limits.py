@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import time
+import collections
+
+clock = getattr(time, 'monotonic', time.time)
+
+#=============================================================================
+# rate limiting and admission control for the web server
+#=============================================================================
+class TokenBucket(object):
+    __slots__ = ['rate', 'burst', 'tokens', 'stamp']
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = clock() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp)*self.rate)
+        self.stamp = now
+
+    def take(self, now, n=1):
+        """ Remove n tokens if available, returning whether they were """
+        self.refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait(self, n=1):
+        """ Seconds until n tokens will be available """
+        return max(0, (n - self.tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key (client address, code, ...) refilling at `rate`
+    tokens per second up to `burst`. Buckets which have refilled completely
+    carry no state, so they are dropped whenever the table grows past `size`.
+    """
+    def __init__(self, rate, burst, size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = {}
+
+    def take(self, key, n=1):
+        now = clock()
+        if key not in self.buckets:
+            if len(self.buckets) >= self.size:
+                self.sweep(now)
+            self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return self.buckets[key].take(now, n)
+
+    def retry_after(self, key):
+        bucket = self.buckets.get(key)
+        return bucket.wait() if bucket else 0
+
+    def sweep(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+
+class Admission(object):
+    """
+    Decides whether a request may start, before any of its body is read.
+    Holds per client and per code rate limits, a cap on the number of
+    transfers in flight, and counts of requests rejected for each reason.
+    """
+    def __init__(self, client_rate=10, client_burst=20, key_rate=0.2,
+            key_burst=5, max_inflight=64):
+        self.clients = RateLimiter(client_rate, client_burst)
+        self.keys = RateLimiter(key_rate, key_burst)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.rejected = collections.Counter()
+
+    def client(self, addr):
+        """ Charge one request to the client, False if over its rate """
+        if self.clients.take(addr):
+            return True
+        self.rejected['client'] += 1
+        return False
+
+    def key(self, code):
+        """ Charge one key attempt to the code, False if over its rate """
+        if self.keys.take(code):
+            return True
+        self.rejected['key'] += 1
+        return False
+
+    def acquire(self):
+        """ Reserve a transfer slot, False if the server is at capacity """
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            self.rejected['inflight'] += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self):
+        self.inflight = max(self.inflight - 1, 0)
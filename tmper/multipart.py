@@ -0,0 +1,174 @@
+from __future__ import print_function
+
+import re
+import uuid
+
+#=============================================================================
+# incremental multipart/form-data, so bodies of unknown length can be
+# produced and consumed without holding them in memory
+#=============================================================================
+CHUNK_SIZE = 1 << 20
+MAX_HEADER_SIZE = 1 << 14
+
+PARAM_REGEX = re.compile(r';\s*([\w\-\*]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*))')
+
+def tobytes(obj):
+    if isinstance(obj, bytes):
+        return obj
+    return obj.encode('utf-8')
+
+def parse_headers(block):
+    """ Part headers as a dict with lowercase names """
+    headers = {}
+    for line in block.decode('utf-8', 'replace').split('\r\n'):
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def parse_params(value):
+    """ Parameters of a header value, 'form-data; name="a"' -> {'name': 'a'} """
+    params = {}
+    for key, quoted, bare in PARAM_REGEX.findall(value):
+        params[key.lower()] = re.sub(r'\\(.)', r'\1', quoted) if quoted else bare.strip()
+    return params
+
+def boundary(content_type):
+    """ The boundary of a multipart content type, None if it is not one """
+    if not content_type.startswith('multipart/form-data'):
+        return None
+    return parse_params(content_type).get('boundary')
+
+
+class Part(object):
+    """ Headers of one part, as given to the target's part_begin """
+    def __init__(self, headers):
+        self.headers = headers
+        disp = parse_params(headers.get('content-disposition', ''))
+        self.name = disp.get('name', '')
+        self.filename = disp.get('filename')
+        self.content_type = headers.get('content-type', 'application/unknown')
+
+
+class Parser(object):
+    """
+    Push parser for multipart/form-data bodies. Feed it the body in chunks of
+    any size and it calls, on target:
+
+        part_begin(part)    with a Part once the headers of a part are read
+        part_data(data)     with consecutive pieces of the part's body
+        part_end()          when the part is complete
+
+    Raises ValueError on malformed input.
+    """
+    def __init__(self, boundary, target):
+        self.delim = b'\r\n--' + tobytes(boundary)
+        self.target = target
+        self.state = 'preamble'
+        # a leading CRLF lets the first boundary match the same delimiter
+        self.buf = b'\r\n'
+
+    def feed(self, data):
+        self.buf += data
+
+        while True:
+            if self.state == 'preamble':
+                idx = self.buf.find(self.delim)
+                if idx < 0:
+                    self.buf = self.buf[-len(self.delim):]
+                    return
+                self.buf = self.buf[idx+len(self.delim):]
+                self.state = 'delim'
+
+            elif self.state == 'delim':
+                if len(self.buf) < 2:
+                    return
+                if self.buf[:2] == b'--':
+                    self.state = 'done'
+                elif self.buf[:2] == b'\r\n':
+                    self.state = 'headers'
+                else:
+                    raise ValueError('malformed multipart boundary')
+                self.buf = self.buf[2:]
+
+            elif self.state == 'headers':
+                idx = self.buf.find(b'\r\n\r\n')
+                if idx < 0:
+                    if len(self.buf) > MAX_HEADER_SIZE:
+                        raise ValueError('multipart headers too large')
+                    return
+                part = Part(parse_headers(self.buf[:idx]))
+                self.buf = self.buf[idx+4:]
+                self.state = 'body'
+                self.target.part_begin(part)
+
+            elif self.state == 'body':
+                idx = self.buf.find(self.delim)
+                if idx < 0:
+                    # keep enough to recognize a delimiter split across chunks
+                    keep = len(self.delim) - 1
+                    if len(self.buf) > keep:
+                        self.target.part_data(self.buf[:-keep])
+                        self.buf = self.buf[-keep:]
+                    return
+                if idx:
+                    self.target.part_data(self.buf[:idx])
+                self.buf = self.buf[idx+len(self.delim):]
+                self.state = 'delim'
+                self.target.part_end()
+
+            else:
+                self.buf = b''
+                return
+
+    def close(self):
+        """ Check that the body ended with the final boundary """
+        if self.state != 'done':
+            raise ValueError('incomplete multipart body')
+
+
+def stream(fields, bound=None, chunk_size=CHUNK_SIZE):
+    """
+    Generate a multipart/form-data body from a list of (name, value) pairs,
+    reading files only as the body is consumed. A value may be a string, a
+    (filename, fileobj, content_type) tuple for a file, or a callable which
+    is evaluated once the body reaches it (e.g. a digest of an earlier file).
+    Returns (content_type, iterator of bytes).
+    """
+    bound = bound or uuid.uuid4().hex
+    content_type = 'multipart/form-data; boundary={}'.format(bound)
+
+    def generate():
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, fileobj, mimetype = value
+                yield head(bound, name, filename, mimetype)
+
+                while True:
+                    data = fileobj.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            else:
+                value = value() if callable(value) else value
+                yield head(bound, name) + tobytes(value)
+
+            yield b'\r\n'
+        yield end(bound)
+
+    return content_type, generate()
+
+
+def head(bound, name, filename=None, mimetype=None):
+    """ The boundary and headers starting a part, of a file if filename is given """
+    out = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(bound, name)
+    if filename is not None:
+        out += '; filename="{}"\r\nContent-Type: {}'.format(
+            filename.replace('"', '\\"'), mimetype
+        )
+    return tobytes(out + '\r\n\r\n')
+
+
+def end(bound):
+    """ The final boundary of a body """
+    return tobytes('--{}--\r\n'.format(bound))
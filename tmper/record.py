@@ -0,0 +1,131 @@
+from __future__ import print_function
+
+import sys
+import time
+import struct
+import binascii
+import dateutil.parser
+
+try:
+    intern = sys.intern
+except AttributeError:
+    intern = intern
+
+#=============================================================================
+# compact metadata records of stored files
+#=============================================================================
+# expiry (epoch seconds), downloads left and the lengths of the raw digest
+# and of the key hash, which are followed in the packed bytes by the digest,
+# the key hash and then the filename
+HEADER = struct.Struct('<IHBB')
+
+# first element of the on-disk form, which is a json list
+VERSION = 1
+
+def tobytes(obj):
+    if isinstance(obj, bytes):
+        return obj
+    return obj.encode('utf-8')
+
+def tostring(obj):
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    return obj
+
+def epoch(date):
+    """ Seconds since the epoch of a naive local datetime """
+    return int(time.mktime(date.timetuple()))
+
+
+class Meta(object):
+    """
+    Metadata of a stored file. Records are immutable, so they are shared
+    rather than copied, and replace() makes a changed one. The numbers, the
+    raw digest, the key's (fixed width) bcrypt hash and the filename share
+    one bytes object, while content types and digest names are interned.
+    """
+    __slots__ = ['packed', 'content_type', 'digest_algo']
+
+    def __init__(self, filename='upload', content_type='application/unknown',
+            expires=0, n=1, key=None, digest=None, digest_algo=None):
+        raw = binascii.unhexlify(digest) if digest else b''
+        key = tobytes(key) if key else b''
+        self.packed = b''.join([
+            HEADER.pack(expires, n, len(raw), len(key)), raw, key, tobytes(filename)
+        ])
+        self.content_type = intern(str(content_type))
+        self.digest_algo = intern(str(digest_algo)) if digest_algo else None
+
+    @property
+    def expires(self):
+        return HEADER.unpack_from(self.packed)[0]
+
+    @property
+    def n(self):
+        return HEADER.unpack_from(self.packed)[1]
+
+    @property
+    def digest(self):
+        size = HEADER.unpack_from(self.packed)[2]
+        raw = self.packed[HEADER.size:HEADER.size+size]
+        return tostring(binascii.hexlify(raw)) if raw else None
+
+    @property
+    def key(self):
+        expires, n, dsize, ksize = HEADER.unpack_from(self.packed)
+        start = HEADER.size + dsize
+        return self.packed[start:start+ksize] or None
+
+    @property
+    def filename(self):
+        expires, n, dsize, ksize = HEADER.unpack_from(self.packed)
+        return tostring(self.packed[HEADER.size+dsize+ksize:])
+
+    def fields(self):
+        return {
+            'filename': self.filename, 'content_type': self.content_type,
+            'expires': self.expires, 'n': self.n, 'key': self.key,
+            'digest': self.digest, 'digest_algo': self.digest_algo,
+        }
+
+    def replace(self, **changes):
+        fields = self.fields()
+        fields.update(changes)
+        return Meta(**fields)
+
+    def encode(self):
+        """ The on-disk form, a list to be written as json """
+        return [
+            VERSION, self.expires, self.n, tostring(self.key) if self.key else None,
+            self.content_type, self.filename, self.digest_algo, self.digest
+        ]
+
+    @classmethod
+    def decode(cls, obj):
+        """ Read the on-disk form, or the dicts written by older versions """
+        if isinstance(obj, dict):
+            expires = epoch(dateutil.parser.parse(obj['time']))
+            return cls(
+                filename=obj.get('filename', 'upload'),
+                content_type=obj.get('content_type', 'application/unknown'),
+                expires=expires, n=obj['n'], key=obj.get('key'),
+                digest=obj.get('digest'), digest_algo=obj.get('digest_algo')
+            )
+
+        version, expires, n, key, ctype, filename, algo, digest = obj
+        if version != VERSION:
+            raise ValueError('unknown metadata version {}'.format(version))
+        return cls(filename, ctype, expires, n, key, digest, algo)
+
+    def __eq__(self, other):
+        return isinstance(other, Meta) and self.encode() == other.encode()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Meta({})'.format(', '.join(
+            '{}={!r}'.format(k, v) for k, v in sorted(self.fields().items())
+        ))
@@ -0,0 +1,106 @@
+from __future__ import print_function
+
+import tornado.gen
+import tornado.locks
+import tornado.iostream
+
+#=============================================================================
+# live relays, one upload fed to one waiting download as it arrives
+#=============================================================================
+READ_SIZE = 1 << 20
+
+class RelayError(IOError):
+    pass
+
+
+class Relay(object):
+    """
+    A payload passed from one sender straight to one receiver, a request
+    handler which is written to and flushed, so the sender is held back
+    until the receiver's connection has taken each chunk. Chunks pushed
+    before a receiver attaches go to `spool` (an Upload) if there is one,
+    otherwise the sender waits for the receiver. A receiver attaching late
+    is fed the spool from disk and goes live once it has caught up.
+    """
+    def __init__(self, code, meta, token, spool=None, size=None):
+        self.code = code
+        self.meta = meta
+        self.token = token
+        self.spool = spool
+        self.size = size
+
+        self.sender = False
+        self.receiver = None
+        self.live = False
+        self.done = False
+        self.error = None
+        self.sent = 0
+
+        self.attached = tornado.locks.Event()
+        self.finished = tornado.locks.Event()
+
+    @tornado.gen.coroutine
+    def push(self, data):
+        """ Pass on a chunk from the sender, resolves once it is taken """
+        if self.receiver is None and self.spool is None:
+            yield self.attached.wait()
+        if self.error:
+            raise RelayError(self.error)
+
+        if self.live:
+            yield self.send(data)
+        else:
+            self.spool.write(data)
+            self.spool.f.flush()
+
+    def close(self):
+        """ The sender is done, everything has been pushed """
+        self.done = True
+        if self.spool is not None and not self.live:
+            self.spool.close()
+        self.finished.set()
+
+    def fail(self, reason):
+        """ Give up on the transfer, waking whichever side is waiting """
+        if self.error is None:
+            self.error = reason
+        self.attached.set()
+        self.finished.set()
+        if self.spool is not None and self.receiver is None:
+            self.spool.abort()
+
+    @tornado.gen.coroutine
+    def send(self, data):
+        try:
+            self.receiver.write(data)
+            yield self.receiver.flush()
+        except (tornado.iostream.StreamClosedError, RuntimeError):
+            self.fail('receiver went away')
+            raise RelayError(self.error)
+        self.sent += len(data)
+
+    @tornado.gen.coroutine
+    def pull(self, handler):
+        """ Feed the whole payload to handler, raising RelayError on failure """
+        self.receiver = handler
+
+        if self.spool is not None:
+            try:
+                with open(self.spool.path, 'rb') as f:
+                    # nothing yields between the last empty read and going
+                    # live, so no chunk can land in the spool unread
+                    while True:
+                        data = f.read(READ_SIZE)
+                        if not data:
+                            break
+                        yield self.send(data)
+            finally:
+                self.spool.abort()
+
+        self.live = True
+        self.attached.set()
+
+        if not self.done:
+            yield self.finished.wait()
+        if self.error:
+            raise RelayError(self.error)
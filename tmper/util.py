@@ -2,12 +2,12 @@ from __future__ import print_function
 
 import re
 import os
+import sys
 import json
 import copy
-import webbrowser
+import time
 import mimetypes
 import requests
-from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 
 try:
     import urlparse
@@ -17,13 +17,25 @@ except Exception as e:
     import urllib.parse as urlparse
     from urllib.parse import urlencode
 
-import pkg_resources
-__version__ = pkg_resources.require("tmper")[0].version
-
+from tmper import __version__
 from tmper import progress
+from tmper import digest
+from tmper import multipart
 
 defaults = {'url': 'https://tmper.co/'}
 
+# download read sizes adapt to throughput so that each read takes roughly
+# CHUNK_TARGET seconds, bounded between CHUNK_MIN and CHUNK_MAX bytes
+CHUNK_MIN = 1 << 16
+CHUNK_MAX = 1 << 23
+CHUNK_TARGET = 0.1
+
+# files of at least RESUMABLE_SIZE are sent in UPLOAD_CHUNK pieces through a
+# resumable session, retrying the chunks which failed up to RETRIES times
+RESUMABLE_SIZE = 1 << 26
+UPLOAD_CHUNK = 1 << 23
+RETRIES = 5
+
 
 # =============================================================================
 # command line utility features
@@ -37,12 +49,17 @@ def argformat(d):
     return '?'+urlencode(out) if out else ''
 
 
-def conf_read(key):
+def conf_load():
+    """ The whole configuration, defaults updated with the user's file """
     defs = copy.deepcopy(defaults)
     filename = conf_file()
     if os.path.exists(filename):
         defs.update(json.load(open(filename)))
-    return defs.get(key)
+    return defs
+
+
+def conf_read(key):
+    return conf_load().get(key)
 
 
 def conf(url='', password=''):
@@ -68,6 +85,7 @@ def download(url, code, password='', browser=False, disp=False):
         raise AssertionError("No URL provided! Provide one or set on via conf.")
 
     if browser:
+        import webbrowser
         arg = argformat({'key': password, 'v': 1})
         rqt = '{}{}'.format(urlparse.urljoin(url, code), arg)
         webbrowser.open(rqt, new=True)
@@ -105,36 +123,162 @@ def download(url, code, password='', browser=False, disp=False):
                 filename = newname
                 break
 
-    chunk_size = 8096
-    nbytes = int(headers['Content-Length'])
-    bar = progress.ProgressBar(nbytes, display=disp)
+    # with an identity encoding the wire length is the file length, so the
+    # output can be allocated up front instead of growing with every write
+    nbytes = int(headers.get('Content-Length', 0))
+    encoded = headers.get('Content-Encoding', 'identity') != 'identity'
+
+    raw = response.raw
+    raw.decode_content = True
+
+    bar = progress.ProgressBar(max(nbytes, 1), display=disp)
     with open(filename, 'wb') as f:
-        response_iter = response.iter_content(chunk_size=chunk_size)
-        for i, chunk in enumerate(response_iter):
-            f.write(chunk)
-            bar.update(i*chunk_size)
-    bar.update(nbytes)
+        if nbytes and not encoded:
+            preallocate(f, nbytes)
+
+        # verify the server's digest on the fly if it sent one we know
+        algo, expected = digest.parse(headers.get('Digest'))
+        hasher = digest.new(algo) if algo else None
+
+        written = stream_into(raw, f, lambda n: bar.update(raw.tell()), hasher)
+        f.truncate(written)
+    bar.update(max(nbytes, 1))
+
+    if hasher and hasher.hexdigest() != expected:
+        response.close()
+        os.remove(filename)
+        raise IOError("Code '{}' failed {} verification".format(code, algo))
 
     response.close()
     return os.path.basename(filename)
 
 
-def upload(url, filename, code='', password='', num=1, time='', disp=False):
-    """ Upload the file 'filename' to tmper url """
+def preallocate(f, nbytes):
+    """ Reserve nbytes on disk for file object f, sparse if unsupported """
+    try:
+        os.posix_fallocate(f.fileno(), 0, nbytes)
+    except (AttributeError, OSError):
+        f.truncate(nbytes)
+
+
+def stream_into(raw, f, callback=None, hasher=None):
+    """
+    Copy the readable stream raw into the file f using one reusable buffer,
+    growing or shrinking the read size with the observed throughput. Returns
+    the number of bytes written. Each chunk is also fed to hasher if given.
+    """
+    buf = memoryview(bytearray(CHUNK_MAX))
+    size = CHUNK_MIN
+    total = 0
+
+    while True:
+        start = time.time()
+        n = raw.readinto(buf[:size])
+        if not n:
+            break
+
+        f.write(buf[:n])
+        total += n
+
+        if hasher:
+            hasher.update(buf[:n])
+
+        if callback:
+            callback(total)
+
+        # aim for CHUNK_TARGET seconds per read at the current rate
+        rate = n / max(time.time() - start, 1e-6)
+        size = int(min(max(rate * CHUNK_TARGET, CHUNK_MIN), CHUNK_MAX))
+
+    return total
+
+
+class HashingReader(object):
+    """ File wrapper which hashes the bytes as the encoder reads them """
+    def __init__(self, f, algo=digest.DEFAULT):
+        self.f = f
+        self.algo = algo
+        self.hasher = digest.new(algo)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hasher.update(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def tell(self):
+        return self.f.tell()
+
+
+class DigestField(object):
+    """
+    Form field holding the digest of a HashingReader. It is placed after the
+    file so that its value is only produced once the file has been streamed,
+    while its (fixed) length is known up front for the encoder.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.value = None
+        self.pos = 0
+        self.size = len(digest.header(reader.algo, reader.hasher.hexdigest()))
+
+    @property
+    def len(self):
+        return self.size - self.pos
+
+    def read(self, size=-1):
+        if self.value is None:
+            self.value = digest.header(
+                self.reader.algo, self.reader.hasher.hexdigest()
+            ).encode('ascii')
+
+        size = self.len if size is None or size < 0 else size
+        out = self.value[self.pos:self.pos+size]
+        self.pos += len(out)
+        return out
+
+
+def upload(url, filename, code='', password='', num=1, time='', disp=False,
+        name='', resumable=None):
+    """
+    Upload the file 'filename' to tmper url. A filename of '-' reads stdin,
+    which like any other pipe is streamed with chunked transfer encoding and
+    is presented to the downloader as 'name'. Large files (or any, if
+    resumable is True) go through a resumable upload session.
+    """
+    from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+
     url = url or conf_read('url')
     password = password or conf_read('pass')
 
     if not url:
         raise AssertionError("No URL provided! Provide one or set on via conf.")
 
-    url = url if not code else urlparse.urljoin(url, code)
     arg = {} if not password else {'key': password}
     arg = arg if num == 1 else dict(arg, n=str(num))
     arg = arg if time == '' else dict(arg, time=time)
 
-    if not os.path.exists(filename):
+    if filename != '-' and not os.path.exists(filename):
         raise IOError("File '{}' does not exist".format(filename))
 
+    if code:
+        url = locate(url, code)
+
+    if filename != '-' and os.path.isfile(filename):
+        if resumable is None:
+            resumable = os.path.getsize(filename) >= RESUMABLE_SIZE
+        if resumable:
+            out = upload_resumable(url, filename, code, arg, name, disp=disp)
+            if out is not None:
+                return out
+
+    url = url if not code else urlparse.urljoin(url, code)
+
+    if filename == '-' or not os.path.isfile(filename):
+        return upload_stream(url, filename, arg, name)
+
     def create_callback(encoder):
         bar = progress.ProgressBar(encoder.len, display=disp)
 
@@ -146,8 +290,14 @@ def upload(url, filename, code='', password='', num=1, time='', disp=False):
     with open(filename, 'rb') as f:
         mimetype = mimetypes.guess_type(filename)[0] or 'application/unknown'
 
-        # prepare the streaming form uploader (with progress bar)
-        encoder = MultipartEncoder(dict(arg, filearg=(filename, f, mimetype)))
+        # prepare the streaming form uploader (with progress bar), hashing
+        # the file as it is sent and trailing the digest after it
+        reader = HashingReader(f)
+        fields = list(arg.items()) + [
+            ('filearg', (name or filename, reader, mimetype)),
+            ('digest', DigestField(reader))
+        ]
+        encoder = MultipartEncoder(fields)
         callback = create_callback(encoder)
         monitor = MultipartEncoderMonitor(encoder, callback)
 
@@ -157,6 +307,193 @@ def upload(url, filename, code='', password='', num=1, time='', disp=False):
         }
 
         r = requests.post(url, data=monitor, headers=header)
-        code = r.content.decode('utf-8')
-        r.close()
-        return code
+        return response_code(r)
+
+
+def upload_stream(url, filename, arg, name=''):
+    """ Upload stdin or a pipe, whose length is unknown, as a chunked body """
+    if filename == '-':
+        f = getattr(sys.stdin, 'buffer', sys.stdin)
+        name = name or 'stdin'
+    else:
+        f = open(filename, 'rb')
+        name = name or os.path.basename(filename)
+
+    with f:
+        mimetype = mimetypes.guess_type(name)[0] or 'application/unknown'
+        reader = HashingReader(f)
+
+        # a generator body makes requests use chunked transfer encoding
+        ctype, body = multipart.stream(list(arg.items()) + [
+            ('filearg', (name, reader, mimetype)),
+            ('digest', lambda: digest.header(reader.algo, reader.hasher.hexdigest()))
+        ])
+
+        header = {
+            'User-Agent': 'tmper/{}'.format(__version__),
+            'Content-Type': ctype
+        }
+
+        r = requests.post(url, data=body, headers=header)
+        return response_code(r)
+
+
+def upload_resumable(url, filename, code, arg, name='', disp=False,
+        chunk_size=UPLOAD_CHUNK, retries=RETRIES):
+    """
+    Upload a file in chunks through a resumable session. Chunks which fail
+    are retried, after asking the server which it has, until all arrive,
+    so a flaky connection only costs the chunks it dropped. Returns None if
+    the server does not support resumable uploads.
+    """
+    base = urlparse.urljoin(url, 'upload')
+    size = os.path.getsize(filename)
+    name = name or filename
+    mimetype = mimetypes.guess_type(name)[0] or 'application/unknown'
+    hdr = {'User-Agent': 'tmper/{}'.format(__version__)}
+
+    with requests.Session() as http:
+        http.headers.update(hdr)
+
+        r = http.post(base, data=dict(
+            arg, size=size, chunk=chunk_size, filename=name,
+            content_type=mimetype, code=code or ''
+        ))
+        if r.status_code == 404 and r.text != 'exists':
+            return None
+        if r.status_code != 200:
+            raise IOError(r.text)
+
+        session = r.json()
+        session_url = '{}/{}'.format(base, session['id'])
+        chunk, count = session['chunk_size'], session['count']
+        received = set(session['received'])
+
+        # the whole file is hashed on the first pass, later passes only
+        # read the chunks which still need sending
+        hasher = digest.new()
+        bar = progress.ProgressBar(max(size, 1), display=disp)
+
+        with open(filename, 'rb') as f:
+            for attempt in range(retries + 1):
+                for i in range(count):
+                    if attempt == 0:
+                        data = f.read(chunk)
+                        hasher.update(data)
+                    elif i in received:
+                        continue
+                    else:
+                        f.seek(i*chunk)
+                        data = f.read(chunk)
+
+                    if i in received:
+                        continue
+
+                    try:
+                        r = http.put('{}/{}'.format(session_url, i), data=data,
+                            headers={'Digest': chunk_digest(data)})
+                        if r.status_code == 200:
+                            received.add(i)
+                            bar.update(min(len(received)*chunk, size))
+                    except requests.RequestException:
+                        pass
+
+                if len(received) == count:
+                    break
+
+                time.sleep(min(2**attempt, 30))
+                try:
+                    received = set(http.get(session_url).json()['received'])
+                except (requests.RequestException, ValueError):
+                    pass
+            else:
+                raise IOError("Upload incomplete, {} of {} chunks sent".format(
+                    len(received), count
+                ))
+
+        bar.update(max(size, 1))
+        r = http.post(session_url, data={
+            'digest': digest.header(digest.DEFAULT, hasher.hexdigest()), 'codeonly': 1
+        })
+        return response_code(r)
+
+
+def upload_relay(url, filename, code='', password='', name='', spool=False,
+        announce=None):
+    """
+    Send a file (or stdin, for '-') straight to whoever downloads its code,
+    without it being stored on the server. The code is passed to announce
+    as soon as it is known, the upload then follows the downloader's pace.
+    With spool, the server holds the file on disk until they show up.
+    """
+    url = url or conf_read('url')
+    password = password or conf_read('pass')
+
+    if not url:
+        raise AssertionError("No URL provided! Provide one or set on via conf.")
+
+    if filename == '-':
+        f = getattr(sys.stdin, 'buffer', sys.stdin)
+        name = name or 'stdin'
+        size = ''
+    elif os.path.exists(filename):
+        f = open(filename, 'rb')
+        name = name or os.path.basename(filename)
+        size = os.path.getsize(filename) if os.path.isfile(filename) else ''
+    else:
+        raise IOError("File '{}' does not exist".format(filename))
+
+    hdr = {'User-Agent': 'tmper/{}'.format(__version__)}
+    mimetype = mimetypes.guess_type(name)[0] or 'application/unknown'
+    url = locate(url, code) if code else url
+
+    with f, requests.Session() as http:
+        http.headers.update(hdr)
+
+        base = urlparse.urljoin(url, 'relay')
+        r = http.post(base, params=dict(
+            key=password or '', code=code or '', filename=name, size=size,
+            content_type=mimetype, spool=1 if spool else ''
+        ))
+        if r.status_code != 200:
+            raise IOError(r.text)
+
+        relay = r.json()
+        if announce:
+            announce(relay['code'])
+
+        # a generator keeps requests from reading the whole file up front
+        body = iter(lambda: f.read(UPLOAD_CHUNK), b'')
+        r = http.put('{}/{}'.format(base, relay['code']), data=body,
+            params={'token': relay['token']})
+        return response_code(r)
+
+
+def locate(url, code):
+    """
+    The URL of the server which owns code, when url is one node of a
+    cluster. Uploads are sent there directly, since a redirect would mean
+    sending (or being unable to resend) the whole body twice.
+    """
+    hdr = {'User-Agent': 'tmper/{}'.format(__version__)}
+    r = requests.head(urlparse.urljoin(url, code), headers=hdr, allow_redirects=False)
+    if r.status_code in (301, 302, 307, 308) and 'Location' in r.headers:
+        location = r.headers['Location']
+        return location[:location.rindex(code)]
+    return url
+
+
+def chunk_digest(data):
+    h = digest.new()
+    h.update(data)
+    return digest.header(digest.DEFAULT, h.hexdigest())
+
+
+def response_code(r):
+    """ The code returned by an upload, raising IOError for an error """
+    code = r.content.decode('utf-8')
+    r.close()
+
+    if r.status_code != 200:
+        raise IOError(code)
+    return code
@@ -1,31 +1,47 @@
 from __future__ import print_function
 
 import os
+import sys
 import json
-import glob
+import errno
 import base64
+import binascii
 import string
 import random
 import itertools
 import signal
+import socket
+import time
 import bcrypt
+import tempfile
 
 import threading
+import subprocess
 import parsedatetime
 import datetime
-import dateutil.parser
 
+import tornado.gen
 import tornado.web
 import tornado.log
 import tornado.ioloop
+import tornado.netutil
+import tornado.iostream
+import tornado.httpserver
 import tornado.template
+import tornado.httputil
+import tornado.httpclient
+
+from tmper import digest
+from tmper import limits
+from tmper import cache
+from tmper import multipart
+from tmper import relay
+from tmper import debug
+from tmper import record
 
 import logging
 logger = logging.getLogger('tmper')
 
-import pkg_resources
-dist = pkg_resources.get_distribution('tmper')
-
 def b64read(path, name):
     return base64.b64encode(open(os.path.join(path, name), 'rb').read())
 
@@ -36,7 +52,7 @@ def key_hash(key, rounds=5):
     return bcrypt.hashpw(_ascii(key), bcrypt.gensalt(rounds))
 
 def key_check(key, hashed_key):
-    return (bcrypt.hashpw(_ascii(key), _ascii(hashed_key)) == _ascii(hashed_key))
+    return (bcrypt.hashpw(_ascii(key), tobytes(hashed_key)) == tobytes(hashed_key))
 
 def tostring(obj):
     if isinstance(obj, bytes):
@@ -58,59 +74,218 @@ CHARS = string.ascii_lowercase + ''.join(map(str, range(10)))
 # flexible configuration options
 MAX_DOWNLOADS = 3
 CODE_LEN = 3
+DIGEST = digest.DEFAULT
+
+# how hard we try to make saved files survive a crash: 'none' leaves it to the
+# OS, 'complete' fsyncs every write before answering, 'batch' groups fsyncs
+# into one pass every FSYNC_INTERVAL seconds
+DURABILITY = 'none'
+DURABILITY_MODES = ['none', 'complete', 'batch']
+FSYNC_INTERVAL = 0.05
+
+# admission control: requests per second (and burst) allowed from one client,
+# key attempts per second (and burst) allowed against one code, and the
+# number of uploads and downloads allowed to run at once
+MAX_BODY_SIZE = int(1e8)
+MAX_FIELD_SIZE = 1 << 16
+CLIENT_RATE = (20, 40)
+KEY_RATE = (0.2, 5)
+MAX_INFLIGHT = 64
+
+# optional in-memory tier: total bytes of payloads kept in RAM (0 disables
+# it) and the largest payload which is eligible
+CACHE_SIZE = 0
+CACHE_MAX_FILE = 1 << 20
+
+# resumable uploads: the largest file accepted, bounds and default for the
+# chunk size, and how long an idle upload session is kept around
+MAX_SESSION_SIZE = 1 << 34
+CHUNK_MIN = 1 << 16
+CHUNK_MAX = 1 << 26
+CHUNK_SIZE = 1 << 23
+SESSION_TTL = 24*3600
+
+# bytes of chunks per session held in memory when they arrive ahead of the
+# digest, so that parallel uploads need not be read back to be hashed
+REORDER_SIZE = 1 << 25
+
+# files are kept in nested directories named by the first SHARD_DEPTH
+# characters of their code, so that no directory grows too large. Files
+# found elsewhere (e.g. from the old flat layout) are served from where they
+# are and moved in MIGRATE_BATCH files at a time, every MIGRATE_PAUSE seconds
+SHARD_DEPTH = 1
+MIGRATE_BATCH = 100
+MIGRATE_PAUSE = 0.05
+
+# live relays: seconds a relayed code waits for its downloader to attach
+# before it is dropped, and the largest payload which can be relayed
+RELAY_WAIT = 600
+MAX_RELAY_SIZE = 1 << 34
+
+# cluster mode: the header marking a request already forwarded by another
+# node, the owner's response headers passed on when proxying a download, and
+# how long a proxied download may take
+FORWARD_HEADER = 'X-Tmper-Forwarded'
+PROXY_HEADERS = [
+    'Content-Type', 'Content-Disposition', 'Content-Length', 'Digest', 'Etag',
+    'Retry-After', 'Location'
+]
+PROXY_TIMEOUT = 3600
+
+# profiling: the longest sampling run allowed, the sampling interval and the
+# number of requests whose phase timings are kept
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = debug.INTERVAL
+TIMING_HISTORY = 1000
+
+# shutdown: seconds to wait for requests in flight before stopping anyway,
+# and for a process started on SIGHUP to take over the listening sockets,
+# which it finds (as file descriptors) in LISTEN_FDS and says it is ready
+# on the pipe in READY_FD
+DRAIN_TIMEOUT = 30
+DRAIN_POLL = 0.1
+HANDOFF_TIMEOUT = 60
+LISTEN_FDS = 'TMPER_LISTEN_FDS'
+READY_FD = 'TMPER_READY_FD'
 
 # build the regex used by the app to determine if valid URL
 CODE_REGEX = string.Template(r'/([$chars]{$num})?')
 CODE_REGEX = CODE_REGEX.substitute(chars=CHARS, num=CODE_LEN)
 
-# decide the template's path, either local of the package global
+# decide the template's path, either local or the one installed alongside
+# the package (setup.py places templates/ next to tmper/)
 local = os.path.exists(os.path.join(os.getcwd(), 'templates', 'index.html'))
-template_dir = './templates' if local else os.path.join(dist.location, 'templates')
-
-FAVICON = b64read(template_dir, 'favicon.png')
-FAVICON2 = b64read(template_dir, 'favicon2.png')
-
-# render most of the webpages right now so they are cached
-subs = {'favicon': FAVICON, 'favicon2': FAVICON2, 'codelen': CODE_LEN}
-loader = tornado.template.Loader(template_dir)
-PAGE_INDEX = loader.load("index.html").generate(**subs)
-PAGE_CODE = loader.load("code.html").generate(**subs)
-PAGE_HELP = loader.load("help.html").generate(**subs)
-PAGE_ERROR = loader.load("error.html").generate(**subs)
-PAGE_DOWNLOAD = loader.load("download.html").generate(**subs)
-
-# also need to leave a few pages templated, let's use string.Template for ease
-TMPL_CODE = string.Template(tostring(PAGE_CODE))
-TMPL_ERROR = string.Template(tostring(PAGE_ERROR))
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+template_dir = os.path.join(os.getcwd() if local else package_dir, 'templates')
+
+# pages are rendered on first use and then cached, so importing this module
+# stays cheap for code which never serves them
+PAGES = {}
+TMPLS = {}
+
+def page(name):
+    """ The rendered page templates/<name>.html """
+    if name not in PAGES:
+        subs = {
+            'favicon': b64read(template_dir, 'favicon.png'),
+            'favicon2': b64read(template_dir, 'favicon2.png'),
+            'codelen': CODE_LEN
+        }
+        loader = tornado.template.Loader(template_dir)
+        PAGES[name] = loader.load(name + '.html').generate(**subs)
+    return PAGES[name]
+
+def tmpl(name):
+    """ A page left templated for string.Template, i.e. $error in error.html """
+    if name not in TMPLS:
+        TMPLS[name] = string.Template(tostring(page(name)))
+    return TMPLS[name]
 
 #=============================================================================
 # helper functions that dont directly involve the web responses
 #=============================================================================
 DEFAULT_ROOT = os.path.join(os.getcwd(), './.tmper-files')
 
+# prefix of partially written files, renamed into place once complete
+TMP_PREFIX = '.tmp-'
+
+def tmp_prefix():
+    """ Prefix of our temporary files, naming the process which writes them """
+    return '{}{}-'.format(TMP_PREFIX, os.getpid())
+
+def live_writer(name):
+    """
+    Whether the temporary file name is being written by another running
+    process, as during a handoff from an old server to a new one
+    """
+    pid = name[len(TMP_PREFIX):].split('-')[0]
+    if not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
 class FileManager(object):
-    def __init__(self, root=DEFAULT_ROOT, char=CHARS, clen=CODE_LEN):
+    def __init__(self, root=DEFAULT_ROOT, char=CHARS, clen=CODE_LEN,
+            durability=DURABILITY, interval=FSYNC_INTERVAL,
+            cache_size=CACHE_SIZE, cache_max_file=CACHE_MAX_FILE,
+            depth=SHARD_DEPTH, partition=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("Unknown durability '{}'".format(durability))
+        if not 0 <= depth < clen:
+            raise ValueError("Shard depth must be less than the code length")
+
         self.char = char
         self.clen = clen
         self.root = root
+        self.depth = depth
+        self.partition = partition
+        self.stray = {}
+        self.metas = {}
         self.timers = {}
 
+        # every state transition (reserve, save, checkout, consume, expire,
+        # delete) holds this lock, since expiry timers fire on their own
+        # threads while requests are handled on the IOLoop
+        self.lock = threading.RLock()
+        self.refs = {}
+        self.doomed = set()
+        self.sessions = {}
+        self.relays = {}
+
+        self.durability = durability
+        self.interval = interval
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.flusher = None
+
+        self.cache = None
+        if cache_size:
+            self.cache = cache.FileCache(cache_size, cache_max_file)
+
         self.init()
 
     def init(self, root=None):
+        with self.lock:
+            self._init(root)
+
+    def _init(self, root=None):
         self.root = root or self.root
         self.cancel_timers()
+        self.refs = {}
+        self.doomed = set()
+        self.sessions = {}
+        self.relays = {}
+        self.metas = {}
+
+        if self.cache:
+            self.cache.clear()
 
         if not os.path.exists(self.root):
             os.mkdir(self.root)
 
-        files = glob.glob(os.path.join(self.root, '?'*self.clen))
-        self.used_codes = set([
-            os.path.basename(f) for f in files
-        ])
+        self.used_codes = self.recover()
+
+        if self.durability == 'batch' and self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+        if self.stray:
+            logger.info('moving {} files into shards'.format(len(self.stray)))
+            migrator = threading.Thread(target=self.migrate_loop)
+            migrator.daemon = True
+            migrator.start()
+
         self.all_codes = set([
             ''.join(i) for i in itertools.product(*(self.char,)*self.clen)
         ])
+
+        # in a cluster, new codes only come from this node's part of the space
+        if self.partition:
+            self.all_codes = set(c for c in self.all_codes if self.partition(c))
         self.start_timer(self.used_codes)
 
     def start_timer(self, codes):
@@ -121,21 +296,24 @@ class FileManager(object):
                 continue
 
             meta = self.open_meta(c)
-            time = date2diff(str2date(meta['time']))
-            time = max([time, 1])
-            self.timers[c] = threading.Timer(time, self.timer_func, args=(c,))
+            wait = max(meta.expires - time.time(), 1)
+            self.timers[c] = threading.Timer(wait, self.timer_func, args=(c,))
             self.timers[c].start()
 
     def timer_func(self, code):
-        logging.info('deleting {}...'.format(code))
-        if self.exists(code):
-            self.delete_file(code)
+        logger.info('deleting {}...'.format(code))
+        with self.lock:
+            if self.timers.get(code) is threading.current_thread():
+                self.timers.pop(code)
+            if self.exists(code):
+                self.retire(code)
 
     def cancel_timers(self):
-        for code, timer in self.timers.items():
-            if timer.isAlive():
-                timer.cancel()
-        self.timers = {}
+        with self.lock:
+            for code, timer in self.timers.items():
+                if timer.is_alive():
+                    timer.cancel()
+            self.timers = {}
 
     def unique_code(self):
         avail = list(self.all_codes.difference(self.used_codes))
@@ -143,76 +321,726 @@ class FileManager(object):
             return None
         return random.choice(avail)
 
+    def reserve(self, name=None):
+        """
+        Claim the code name, or a random free code if None, so that no other
+        upload can take it. Returns None if it is taken or none are left.
+        """
+        with self.lock:
+            while True:
+                code = name or self.unique_code()
+                if code is None or code in self.used_codes:
+                    return None
+                self.used_codes.add(code)
+
+                # while handing over, the other server may have saved it
+                if not os.path.exists(self.pathj(code)):
+                    return code
+                if name:
+                    return None
+
+    def unreserve(self, name):
+        """ Give back a reserved code which was never saved """
+        with self.lock:
+            if not os.path.exists(self.pathj(name)):
+                self.used_codes.discard(name)
+
+    def checkout(self, name):
+        """
+        Open a file for download and pin it, so that it is not deleted by
+        expiry or by other downloads until checkin(name) is called. Returns
+        (None, None) if there is no such file.
+        """
+        with self.lock:
+            if not self.exists(name):
+                return None, None
+            data, meta = self.open_file(name)
+            self.refs[name] = self.refs.get(name, 0) + 1
+            return data, meta
+
+    def checkin(self, name):
+        """ Unpin a file, deleting it if it was retired in the meantime """
+        with self.lock:
+            self.refs[name] -= 1
+            if self.refs[name] <= 0:
+                self.refs.pop(name)
+                if name in self.doomed:
+                    self.delete_file(name)
+
+    def consume(self, name):
+        """ Use up one download of a file, False if none were left """
+        with self.lock:
+            if not self.exists(name):
+                return False
+
+            meta = self.open_meta(name)
+            if meta.n <= 1:
+                self.retire(name)
+            else:
+                self.update_meta(name, meta.replace(n=meta.n - 1))
+            return True
+
+    def unconsume(self, name):
+        """
+        Give back a download used up by a transfer which was cut off, as
+        by a shutdown which could not wait for it any longer
+        """
+        with self.lock:
+            if name in self.doomed:
+                # it was the last download, the pin kept the file around
+                self.doomed.discard(name)
+            elif self.exists(name):
+                meta = self.open_meta(name)
+                self.update_meta(name, meta.replace(n=meta.n + 1))
+
+    def retire(self, name):
+        """
+        Make a file unavailable, deleting it now or, if downloads of it are
+        still running, once the last of them checks it back in
+        """
+        with self.lock:
+            self.doomed.add(name)
+            if not self.refs.get(name):
+                self.delete_file(name)
+
+    def lookup(self, name):
+        """ Metadata of an available file, None if there is none """
+        with self.lock:
+            if not self.exists(name):
+                return None
+            return self.open_meta(name)
+
+    def shard(self, n):
+        """ Directory in which the files of code n belong """
+        return os.path.join(self.root, *n[:self.depth])
+
     def path(self, n):
-        return os.path.join(self.root, n)
+        return os.path.join(self.stray.get(n) or self.shard(n), n)
 
     def pathj(self, n):
-        return os.path.join(self.root, '{}.json'.format(n))
+        return os.path.join(self.stray.get(n) or self.shard(n), '{}.json'.format(n))
+
+    def scan(self):
+        """
+        Find the payload and metadata files of every code below the root,
+        at any depth. Returns two dicts of code -> directory and a list of
+        the paths of partially written files.
+        """
+        payloads, metas, partial = {}, {}, []
+
+        def valid(name):
+            return len(name) == self.clen and all(c in self.char for c in name)
+
+        def walk(path, level):
+            for name in os.listdir(path):
+                full = os.path.join(path, name)
+                if level < self.clen - 1 and len(name) == 1 and os.path.isdir(full):
+                    walk(full, level + 1)
+                elif valid(name):
+                    payloads[name] = path
+                elif name.endswith('.json') and valid(name[:-len('.json')]):
+                    metas[name[:-len('.json')]] = path
+                elif name.startswith(TMP_PREFIX) and not live_writer(name):
+                    partial.append(full)
+
+        walk(self.root, 0)
+        return payloads, metas, partial
+
+    def make_shard(self, path):
+        """ Create the shard directory path and any missing parents """
+        parts = os.path.relpath(path, self.root).split(os.sep)
+        for i in range(len(parts)):
+            sub = os.path.join(self.root, *parts[:i+1])
+            try:
+                os.mkdir(sub)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            if self.durability != 'none':
+                fsync_dir(os.path.dirname(sub))
+
+    def move(self, code, src):
+        """ Move whichever files of code are in directory src into its shard """
+        dst = self.shard(code)
+        if src != dst:
+            self.make_shard(dst)
+            for name in (code, '{}.json'.format(code)):
+                if os.path.exists(os.path.join(src, name)):
+                    replace(os.path.join(src, name), os.path.join(dst, name))
+            if self.durability != 'none':
+                fsync_dir(src)
+                fsync_dir(dst)
+        self.stray.pop(code, None)
+
+    def migrate(self, count=MIGRATE_BATCH):
+        """ Move up to count stray files into their shards, returns how many are left """
+        with self.lock:
+            for code in list(self.stray)[:count]:
+                self.move(code, self.stray[code])
+            return len(self.stray)
+
+    def migrate_loop(self):
+        # short batches so that requests never wait long on the lock
+        try:
+            while self.migrate():
+                time.sleep(MIGRATE_PAUSE)
+        except (IOError, OSError) as e:
+            logger.warning('moving files into shards failed: {}'.format(e))
 
     def save_file(self, name, content, meta):
-        self.update_file(name, content)
-        self.update_meta(name, meta)
-
-        self.start_timer(name)
-        self.used_codes.update([name])
+        with self.lock:
+            self.update_file(name, content)
+            self.update_meta(name, meta)
+
+            if self.cache:
+                self.cache.put(name, content, meta)
+
+            self.start_timer(name)
+            self.used_codes.update([name])
+
+    def new_upload(self):
+        """ Temporary file in the storage root for a payload being received """
+        return Upload(self.root, self.cache.threshold if self.cache else 0)
+
+    def save_upload(self, name, upload, meta):
+        """ Like save_file, but moves a completely received Upload into place """
+        with self.lock:
+            upload.close(fsync=self.durability == 'complete')
+            self.place(upload.path, self.path(name))
+            self.update_meta(name, meta)
+
+            if self.cache and upload.data is not None:
+                self.cache.put(name, upload.data, meta)
+
+            self.start_timer(name)
+            self.used_codes.update([name])
+
+    def new_session(self, size, chunk_size, meta):
+        """ Start a resumable upload, dropping sessions idle for too long """
+        with self.lock:
+            now = limits.clock()
+            for sid, session in list(self.sessions.items()):
+                if now - session.touched > SESSION_TTL:
+                    self.end_session(sid)
+
+            session = Session(self.root, size, chunk_size, meta)
+            self.sessions[session.id] = session
+            return session
+
+    def session(self, sid):
+        with self.lock:
+            session = self.sessions.get(sid)
+            if session:
+                session.touched = limits.clock()
+            return session
+
+    def end_session(self, sid, abort=True):
+        """ Forget an upload session, removing its data unless it was saved """
+        with self.lock:
+            session = self.sessions.pop(sid, None)
+            if session and abort:
+                session.abort()
+
+    def new_relay(self, name, meta, size=None, spool=False):
+        """
+        Reserve the code name (or a new one) for a live relay, spooling to
+        disk until the downloader attaches if spool. None if it is taken.
+        """
+        with self.lock:
+            name = self.reserve(name or None)
+            if name is None:
+                return None
+
+            token = tostring(binascii.hexlify(os.urandom(16)))
+            spool = self.new_upload() if spool else None
+            self.relays[name] = relay.Relay(name, meta, token, spool, size)
+            return self.relays[name]
+
+    def relay(self, name):
+        with self.lock:
+            return self.relays.get(name)
+
+    def end_relay(self, name, reason='closed'):
+        """ Forget a relay and free its code, failing it if still running """
+        with self.lock:
+            r = self.relays.pop(name, None)
+            if r is not None:
+                if not (r.done and r.live):
+                    r.fail(reason)
+                self.unreserve(name)
 
     def update_file(self, name, content):
-        with open(self.path(name), 'wb') as f:
-            f.write(content)
+        self.write_atomic(self.path(name), lambda f: f.write(content), 'wb')
 
     def update_meta(self, name, meta):
-        with open(self.pathj(name), 'w') as f:
-            json.dump(meta, f)
+        self.write_atomic(
+            self.pathj(name),
+            lambda f: json.dump(meta.encode(), f, separators=(',', ':')), 'w'
+        )
+        self.metas[name] = meta
+        if self.cache:
+            self.cache.update_meta(name, meta)
+
+    def write_atomic(self, path, writer, mode):
+        """ Write to a temporary file with writer(f), then rename into path """
+        # next to path, since a rename within one directory is the cheapest
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=tmp_prefix())
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.make_shard(os.path.dirname(path))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=tmp_prefix())
+        try:
+            with os.fdopen(fd, mode) as f:
+                writer(f)
+                if self.durability == 'complete':
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.place(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def place(self, tmp, path):
+        """ Rename a finished temporary file to path, persisting the rename """
+        try:
+            replace(tmp, path)
+        except OSError as e:
+            # shard directories are only made once something goes in them
+            if e.errno != errno.ENOENT or not os.path.exists(tmp):
+                raise
+            self.make_shard(os.path.dirname(path))
+            replace(tmp, path)
+
+        if self.durability == 'complete':
+            fsync_dir(os.path.dirname(path))
+        elif self.durability == 'batch':
+            with self.pending_lock:
+                self.pending.add(path)
+
+    def flush(self):
+        """ Fsync all files written since the last flush (batch durability) """
+        with self.pending_lock:
+            paths, self.pending = self.pending, set()
+
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                # deleted before we got to it, nothing to persist
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        for path in set(os.path.dirname(p) for p in paths):
+            fsync_dir(path)
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def recover(self):
+        """
+        Clean up after a crash: remove partial writes and any payload or
+        metadata file which is missing its partner or cannot be parsed.
+        Files outside their shard are noted in self.stray for migration.
+        Returns the codes of the files which are intact.
+        """
+        payloads, metas, partial = self.scan()
+        for tmp in partial:
+            logger.info('removing partial write {}'.format(tmp))
+            os.remove(tmp)
+
+        self.stray = {}
+        intact = set()
+
+        for code in set(payloads).union(metas):
+            where = set([payloads.get(code), metas.get(code)])
+            where.discard(None)
+
+            if len(where) > 1:
+                # a move into the shard was interrupted, finish it
+                for src in where:
+                    self.move(code, src)
+            elif where != set([self.shard(code)]):
+                self.stray[code] = where.pop()
+
+            try:
+                self.open_meta(code)
+                ok = self.exists(code)
+            except (IOError, OSError, ValueError):
+                ok = False
+
+            if ok:
+                intact.add(code)
+            else:
+                logger.warning('removing incomplete file {}'.format(code))
+                for path in (self.path(code), self.pathj(code)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.stray.pop(code, None)
+                self.metas.pop(code, None)
+        return intact
 
     def open_file(self, name):
-        data = open(self.path(name)).read()
-        meta = open(self.pathj(name)).read()
-        return data, json.loads(meta)
+        if self.cache:
+            data, meta = self.cache.get(name)
+            if data is not None:
+                return data, meta
+
+        data = open(self.path(name), 'rb').read()
+        return data, self.open_meta(name)
 
     def open_meta(self, name):
-        return json.load(open(self.pathj(name)))
+        """ The metadata record of a file, read from disk only once """
+        meta = self.metas.get(name)
+        if meta is None:
+            with open(self.pathj(name)) as f:
+                meta = record.Meta.decode(json.load(f))
+            self.metas[name] = meta
+        return meta
 
     def delete_file(self, name):
-        os.remove(self.path(name))
-        os.remove(self.pathj(name))
+        with self.lock:
+            for path in (self.path(name), self.pathj(name)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+            if name in self.timers:
+                timer = self.timers.pop(name)
+                if timer.is_alive():
+                    timer.cancel()
 
-        if name in self.timers:
-            timer = self.timers.pop(name)
-            if timer.isAlive():
-                timer.cancel()
+            self.used_codes.discard(name)
+            self.doomed.discard(name)
+            self.stray.pop(name, None)
+            self.metas.pop(name, None)
 
-        self.used_codes.remove(name)
+            if self.cache:
+                self.cache.discard(name)
 
     def exists(self, name):
-        return os.path.isfile(self.path(name))
+        return name not in self.doomed and os.path.isfile(self.path(name))
+
+class Upload(object):
+    """
+    A payload being received, written to a temporary file as it arrives so
+    that bodies of any length pass through without being held in memory.
+    Payloads of at most `keep` bytes are also kept in memory for the cache.
+    """
+    def __init__(self, root, keep=0):
+        fd, self.path = tempfile.mkstemp(dir=root, prefix=tmp_prefix())
+        self.f = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.keep = keep
+        self.chunks = [] if keep else None
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+        if self.chunks is not None:
+            if self.size <= self.keep:
+                self.chunks.append(bytes(data))
+            else:
+                self.chunks = None
+
+    @property
+    def data(self):
+        return b''.join(self.chunks) if self.chunks is not None else None
+
+    def close(self, fsync=False):
+        if not self.f.closed:
+            self.f.flush()
+            if fsync:
+                os.fsync(self.f.fileno())
+            self.f.close()
+
+    def abort(self):
+        """ Throw away a payload which will not be saved """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Session(object):
+    """
+    A resumable upload of a known size, assembled from fixed size chunks
+    which may arrive in any order, more than once and over many requests.
+    The digest is advanced while chunks arrive in order. Chunks which arrive
+    a little early (as with parallel uploads) wait in memory for their turn,
+    and only those that did not fit are read back when the session finishes.
+    """
+    def __init__(self, root, size, chunk_size, meta):
+        self.id = tostring(binascii.hexlify(os.urandom(16)))
+        self.size = size
+        self.chunk_size = chunk_size
+        self.count = max(1, -(-size // chunk_size))
+        self.meta = meta
+        self.received = set()
+        self.touched = limits.clock()
+
+        self.hashes = {a: digest.new(a) for a in set([DIGEST, digest.DEFAULT])}
+        self.hashed = 0
+        self.early = {}
+        self.early_size = 0
+        self.data = None
+
+        fd, self.path = tempfile.mkstemp(dir=root, prefix=tmp_prefix())
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def offset(self, index):
+        return index * self.chunk_size
+
+    def length(self, index):
+        return min(self.chunk_size, self.size - self.offset(index))
+
+    def missing(self):
+        return [i for i in range(self.count) if i not in self.received]
+
+    def complete(self):
+        return len(self.received) == self.count
+
+    def mark(self, index, hashes=None, data=None):
+        """
+        Record that chunk index was written. If it is the next chunk to be
+        hashed, hashes are the session's hashers advanced over it, otherwise
+        data may hold its bytes to hash once the chunks before it are in.
+        """
+        self.received.add(index)
+        if hashes is not None and index == self.hashed:
+            self.hashes = hashes
+            self.hashed += 1
+        elif data is not None and index > self.hashed and index not in self.early:
+            if self.early_size + len(data) <= REORDER_SIZE:
+                self.early[index] = data
+                self.early_size += len(data)
+
+        while self.hashed in self.early:
+            self.advance(self.take(self.hashed))
+
+    def take(self, index):
+        data = self.early.pop(index)
+        self.early_size -= len(data)
+        return data
+
+    def advance(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+        self.hashed += 1
+
+    def digests(self):
+        """ Hashers over the whole payload, reading back what is needed """
+        with open(self.path, 'rb') as f:
+            while self.hashed < self.count:
+                if self.hashed in self.early:
+                    self.advance(self.take(self.hashed))
+                else:
+                    f.seek(self.offset(self.hashed))
+                    self.advance(f.read(self.length(self.hashed)))
+        return self.hashes
+
+    def close(self, fsync=False):
+        if fsync:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def abort(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def pwrite(fd, data, offset):
+    """ Positional write of all of data, for platforms with or without pwrite """
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+replace = getattr(os, 'replace', os.rename)
+
+def fsync_dir(path):
+    """ Persist renames and unlinks within directory path """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 def dt2date(dt):
     cal = parsedatetime.Calendar()
     return cal.parseDT(dt, datetime.datetime.now())[0]
 
-def str2date(string):
-    return dateutil.parser.parse(string)
-
-def date2diff(date):
-    return (date - datetime.datetime.now()).total_seconds()
-
 files = None
-
-def signal_handler(signum, frame):
+admission = None
+peers = None
+timings = None
+server_timing = False
+
+# the listening sockets, the transfers in flight and how shutdowns proceed
+server = None
+sockets = []
+active = set()
+draining = False
+drain_wait = DRAIN_TIMEOUT
+restart_command = None
+
+def signal_handler(signum, frame=None):
+    """ Run on the IOLoop, see handle_signals """
+    if signum == getattr(signal, 'SIGHUP', None):
+        handoff()
+    elif draining:
+        # asked again, so stop without waiting
+        shutdown()
+    else:
+        drain()
+
+def handle_signals(ioloop):
+    """
+    Have SIGINT and SIGTERM drain the server and SIGHUP hand it over. The
+    asyncio loop wakes up for its signal handlers, while a plain handler
+    would only run once something else woke the loop.
+    """
+    names = [n for n in ['SIGINT', 'SIGTERM', 'SIGHUP'] if hasattr(signal, n)]
+    loop = getattr(ioloop, 'asyncio_loop', None)
+
+    for name in names:
+        signum = getattr(signal, name)
+        if loop is not None:
+            loop.add_signal_handler(signum, signal_handler, signum)
+        else:
+            signal.signal(signum, lambda signum, frame: ioloop.add_callback_from_signal(
+                signal_handler, signum
+            ))
+
+@tornado.gen.coroutine
+def drain():
+    """
+    Stop accepting connections and give the transfers in flight up to
+    drain_wait seconds to finish before shutting down. Downloads which
+    are cut off get their download back.
+    """
+    global draining
+    if draining:
+        return
+    draining = True
+    server.stop()
+
+    logging.info('draining {} transfers...'.format(len(active)))
+    deadline = time.time() + drain_wait
+    while active and time.time() < deadline:
+        yield tornado.gen.sleep(DRAIN_POLL)
+
+    for handler in list(active):
+        handler.abandon()
+    shutdown()
+
+def shutdown():
     logging.info('exiting...')
     files.cancel_timers()
+    files.flush()
     tornado.ioloop.IOLoop.instance().stop()
     logging.info('done.')
 
+@tornado.gen.coroutine
+def handoff():
+    """
+    Start a new server on our listening sockets and drain once it is ready,
+    so that a restart neither refuses connections nor cuts transfers off.
+    Connections arriving meanwhile are accepted by whichever is quicker.
+    """
+    if draining:
+        return
+
+    fds = [sock.fileno() for sock in sockets]
+    for fd in fds:
+        os.set_inheritable(fd, True)
+    rfd, wfd = os.pipe()
+
+    env = dict(os.environ)
+    env[LISTEN_FDS] = ','.join(str(fd) for fd in fds)
+    env[READY_FD] = str(wfd)
+    command = restart_command or getattr(sys, 'orig_argv', [sys.executable] + sys.argv)
+
+    logging.info('starting {}'.format(' '.join(command)))
+    proc = subprocess.Popen(command, env=env, pass_fds=fds + [wfd])
+    os.close(wfd)
+
+    pipe = tornado.iostream.PipeIOStream(rfd)
+    try:
+        yield tornado.gen.with_timeout(
+            datetime.timedelta(seconds=HANDOFF_TIMEOUT), pipe.read_bytes(1)
+        )
+    except (tornado.gen.TimeoutError, tornado.iostream.StreamClosedError):
+        logging.error('new server did not start, still serving')
+        if proc.poll() is None:
+            proc.kill()
+        return
+    finally:
+        pipe.close()
+
+    logging.info('handed over to process {}'.format(proc.pid))
+    drain()
+
+def listen(port, addr):
+    """ Sockets handed over by the server we replace, or newly bound ones """
+    fds = os.environ.pop(LISTEN_FDS, None)
+    if not fds:
+        return tornado.netutil.bind_sockets(port, addr)
+
+    out = []
+    for fd in fds.split(','):
+        sock = socket.socket(fileno=int(fd))
+        sock.setblocking(False)
+        out.append(sock)
+    return out
+
+def ready():
+    """ Tell the server we replace that we are serving """
+    fd = os.environ.pop(READY_FD, None)
+    if fd:
+        os.write(int(fd), b'1')
+        os.close(int(fd))
+
 #=============================================================================
 # The actual web application now
 #=============================================================================
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
+            (r"/debug/profile", ProfileHandler),
+            (r"/debug/timings", TimingsHandler),
+        ] if timings is not None else []
+
+        handlers += [
             (r"/help", HelpHandler),
             (r"/error-size", ErrorSizeHandler),
             (r"/download", DownloadHandler),
+            (r"/upload", SessionHandler),
+            (r"/upload/([0-9a-f]+)", SessionHandler),
+            (r"/upload/([0-9a-f]+)/([0-9]+)", ChunkHandler),
+            (r"/relay", RelayHandler),
+            (r"/relay/([{}]+)".format(CHARS), RelayHandler),
             (CODE_REGEX, MainHandler)
         ]
         super(Application, self).__init__(
@@ -220,15 +1048,23 @@ class Application(tornado.web.Application):
         )
 
 class Handler(tornado.web.RequestHandler):
-    def error(self, text, code=404):
+    def finish(self, *args, **kwargs):
+        # while draining, send clients to the next server for more requests
+        if draining and not self._headers_written:
+            self.set_header('Connection', 'close')
+        return super(Handler, self).finish(*args, **kwargs)
+
+    def error(self, text, code=404, headers=None):
         self.clear()
         self.set_status(code)
+        for k, v in (headers or {}).items():
+            self.set_header(k, v)
 
         if self.cli():
             self.write(text)
         else:
             text = tostring(text)
-            self.write(TMPL_ERROR.substitute(error=text))
+            self.write(tmpl('error').substitute(error=text))
         self.finish()
 
     def cli(self):
@@ -240,16 +1076,21 @@ class Handler(tornado.web.RequestHandler):
     def cache_headers(self, nhours=24):
         self.set_header('Cache-Control', 'public,max-age=%d' % int(3600*nhours))
 
+    def get_arg(self, key, default):
+        val = self.request.arguments.get(key, [default])[0]
+        val = tostring(val)
+        return val
+
 class HelpHandler(Handler):
     def get(self):
         self.cache_headers()
-        self.write(PAGE_HELP)
+        self.write(page('help'))
         self.finish()
 
 class DownloadHandler(Handler):
     def get(self):
         self.cache_headers()
-        self.write(PAGE_DOWNLOAD)
+        self.write(page('download'))
         self.finish()
 
 class DefaultHandler(Handler):
@@ -263,30 +1104,397 @@ class ErrorSizeHandler(Handler):
     def get(self):
         self.error('Filesize > 128MB', 413)
 
-class MainHandler(Handler):
+class ProfileHandler(Handler):
+    """ /debug/profile?seconds=N, collapsed stacks of the IOLoop thread """
+    running = False
+
+    @tornado.gen.coroutine
+    def get(self):
+        try:
+            seconds = float(self.get_arg('seconds', 10))
+        except ValueError:
+            self.error('invalid seconds', 400)
+            return
+
+        if ProfileHandler.running:
+            self.error('already profiling', 409)
+            return
+
+        # requests run on this thread, so that is the one to sample
+        ProfileHandler.running = True
+        sampler = debug.Sampler(threading.current_thread().ident, PROFILE_INTERVAL)
+        sampler.start()
+        try:
+            yield tornado.gen.sleep(max(0, min(seconds, PROFILE_MAX_SECONDS)))
+        finally:
+            sampler.stop()
+            ProfileHandler.running = False
+
+        self.set_header('Content-Type', 'text/plain')
+        self.write(sampler.collapsed())
+        self.finish()
+
+class TimingsHandler(Handler):
+    """ /debug/timings, phase timings of the latest requests """
+    def get(self):
+        entries = list(timings.entries)[-int(self.get_arg('n', 100)):]
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'summary': timings.summary(), 'recent': entries}))
+        self.finish()
+
+class TransferHandler(Handler):
+    """
+    Base for handlers which move files. Bodies are streamed by subclasses,
+    so prepare() runs once the headers arrive and can turn requests away
+    before reading any of the body.
+    """
+    def prepare(self, *args, **kwargs):
+        self.slot = False
+        self.timing = None
+        active.add(self)
+        if timings is not None or server_timing:
+            self.timing = debug.Timing()
+        super(TransferHandler, self).prepare(*args, **kwargs)
+
+        addr = self.request.remote_ip
+        if not admission.client(addr):
+            wait = admission.clients.retry_after(addr)
+            self.error('too many requests', 429, {'Retry-After': int(wait) + 1})
+            return
+
+        if self.transfer():
+            if not admission.acquire():
+                self.error('server busy', 503, {'Retry-After': 1})
+                return
+            self.slot = True
+        self.mark('admit')
+
+    def mark(self, phase):
+        """ End a phase of the request's timing, if it is being timed """
+        if self.timing is not None:
+            self.timing.mark(phase)
+
+    def finish(self, *args, **kwargs):
+        if server_timing and self.timing is not None and not self._headers_written:
+            self.set_header('Server-Timing', self.timing.header())
+        future = super(TransferHandler, self).finish(*args, **kwargs)
+
+        # hold on to the file (and keep a shutdown waiting) until the
+        # response has been written out, not just queued
+        if future is None:
+            self.release()
+        else:
+            future.add_done_callback(self.flushed)
+        return future
+
+    def flushed(self, future):
+        if not future.cancelled():
+            future.exception()
+        self.release()
+
+    def transfer(self):
+        """ Whether this request moves a file rather than fetching a page """
+        return True
+
+    def release(self):
+        active.discard(self)
+        if self.slot:
+            self.slot = False
+            admission.release()
+
+    def abandon(self):
+        """
+        Undo what the request did, as the server is about to stop without
+        waiting for it. Only downloads need to: what partial uploads, chunks
+        and relays leave behind is in memory or cleaned up on startup.
+        """
+        pass
+
+    def on_finish(self):
+        if timings is not None and self.timing is not None:
+            self.mark('flush')
+            route = '{} {}'.format(self.request.method, type(self).__name__)
+            timings.record(route, self.get_status(), self.timing)
+
+    def on_connection_close(self):
+        self.release()
+
+    def upload_meta(self):
+        """ Metadata for a new file from the request arguments, None on error """
+        meta = {}
+        meta['key'] = self.get_arg('key', None)
+        usern = int(self.get_arg('n', 1))
+        usern = max(min(usern, MAX_DOWNLOADS), 0)
+        meta['n'] = usern
+
+        if meta['key']:
+            meta['key'] = tostring(key_hash(meta['key']))
+
+        try:
+            time = dt2date(self.get_arg('time', '3 days'))
+        except Exception as e:
+            self.error('invalid time')
+            return None
+
+        # limit the time between valid parameters
+        tmin = dt2date('1 min')
+        tmax = dt2date('7 days')
+        time = max(tmin, min(tmax, time))
+        meta['expires'] = record.epoch(time)
+        return meta
+
+    def save(self, args, upload, meta, hashes):
+        """
+        Save a completely received upload under the code args (or a new one)
+        and reply with the code. hashes maps digest algorithms to hashers
+        which have seen the whole payload.
+        """
+        name = files.reserve(args or None)
+
+        if name is None:
+            upload.abort()
+            self.error('exists' if args else "no codes available")
+            return
+        self.mark('reserve')
+
+        # strip paths from meta name (can't be done on client)
+        if 'filename' in meta:
+            meta['filename'] = os.path.basename(meta['filename'])
+
+        # the client sends its digest after the file, so check it against
+        # the ones we computed while receiving the file
+        calgo, chex = digest.parse(self.get_arg('digest', ''))
+        if calgo in hashes and hashes[calgo].hexdigest() != chex:
+            upload.abort()
+            files.unreserve(name)
+            self.error('digest mismatch', 400)
+            return
+
+        meta['digest_algo'] = DIGEST
+        meta['digest'] = hashes[DIGEST].hexdigest()
+        self.mark('digest')
+
+        # move the file into place and return the accepted name
+        meta = record.Meta(**meta)
+        files.save_upload(name, upload, meta)
+        self.digest_headers(meta)
+        self.mark('save')
+
+        if not self.cli() and not self.get_arg('codeonly', None):
+            response = tmpl('code').substitute(namecode=name)
+            self.write(response)
+        else:
+            self.write(name)
+        self.finish()
+
+    def digest_headers(self, meta):
+        if meta.digest:
+            self.set_header('Digest', digest.header(meta.digest_algo, meta.digest))
+            self.set_header('Etag', '"{}"'.format(meta.digest))
+
+    def remote(self, code):
+        """ Whether code is another cluster node's, and not here after all """
+        if peers is None or not code or peers.owns(code):
+            return False
+        if self.request.headers.get(FORWARD_HEADER):
+            return False
+        return not files.exists(code) and files.relay(code) is None
+
+    def forward(self, code):
+        """
+        Hand the request on to the node owning code: downloads are proxied
+        if the cluster is set up to, anything else is redirected
+        """
+        url = peers.url(code, self.request.uri)
+        if self.request.method == 'GET' and peers.forward == 'proxy':
+            return self.proxy(url)
+        self.redirect(url, status=307)
+
+    @tornado.gen.coroutine
+    def proxy(self, url):
+        """ Pass on the response to this request from url as it arrives """
+        start = []
+        headers = tornado.httputil.HTTPHeaders()
+
+        def header_line(line):
+            line = line.rstrip('\r\n')
+            if not start:
+                start.append(tornado.httputil.parse_response_start_line(line))
+            elif line:
+                headers.parse_line(line)
+
+        def begin():
+            if start and not self._headers_written:
+                self.set_status(start[-1].code, start[-1].reason)
+                for name in PROXY_HEADERS:
+                    if name in headers:
+                        self.set_header(name, headers[name])
+
+        def body(chunk):
+            begin()
+            self.write(chunk)
+            self.flush()
+
+        request = tornado.httpclient.HTTPRequest(
+            url, method=self.request.method, follow_redirects=False,
+            decompress_response=False, request_timeout=PROXY_TIMEOUT,
+            header_callback=header_line, streaming_callback=body,
+            headers={
+                FORWARD_HEADER: '1',
+                'User-Agent': self.request.headers.get('User-Agent', '')
+            }
+        )
+
+        try:
+            yield tornado.httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+        except Exception as e:
+            logger.warning('forwarding to {} failed: {}'.format(url, e))
+            if self._headers_written:
+                self.request.connection.close()
+            else:
+                self.error('node unavailable', 502)
+            return
+
+        begin()
+        self.finish()
+
+@tornado.web.stream_request_body
+class MainHandler(TransferHandler):
     def prepare(self, *args, **kwargs):
-        self.request.connection.set_max_body_size(int(1e8))
+        self.pinned = None
+        self.consumed = False
+        self.relaying = None
+        self.parser = None
+        self.upload = None
+        self.rejected = False
+        self.received = 0
         super(MainHandler, self).prepare(*args, **kwargs)
+        if self._finished:
+            return
+
+        # uploads to another node's code go there before sending the body
+        if self.request.method == 'POST' and self.remote(self.path_args[0]):
+            self.forward(self.path_args[0])
+            return
+
+        # we enforce MAX_BODY_SIZE ourselves as the body arrives so that even
+        # chunked bodies get a proper 413, tornado's own limit is a backstop
+        length = int(self.request.headers.get('Content-Length', 0) or 0)
+        if length > MAX_BODY_SIZE:
+            self.error('Filesize > {}MB'.format(MAX_BODY_SIZE // 10**6), 413)
+            return
+        self.request.connection.set_max_body_size(2*MAX_BODY_SIZE)
+
+        # multipart bodies are parsed as they arrive, with the file written
+        # straight to disk, so their length need not be known up front
+        bound = multipart.boundary(self.request.headers.get('Content-Type', ''))
+        if self.request.method == 'POST' and bound:
+            self.parser = multipart.Parser(bound, self)
+
+    def transfer(self):
+        if self.request.method == 'POST':
+            return True
+        return bool(self.path_args and self.path_args[0]) or 'code' in self.request.arguments
+
+    def data_received(self, chunk):
+        if self.rejected or self.parser is None:
+            return
+
+        # bodies without a length are only limited by what actually arrives
+        self.received += len(chunk)
+        if self.received > MAX_BODY_SIZE:
+            self.reject('Filesize > {}MB'.format(MAX_BODY_SIZE // 10**6), 413)
+            return
+
+        try:
+            self.parser.feed(chunk)
+        except ValueError as e:
+            self.reject(str(e), 400)
+
+    def reject(self, text, code):
+        """ Fail an upload part way through its body """
+        self.rejected = True
+        self.error(text, code)
+
+    def part_begin(self, part):
+        self.part = part
+        self.field = []
+
+        if part.filename is not None:
+            if self.upload is not None:
+                raise ValueError('one file at a time')
+
+            self.upload = files.new_upload()
+            self.hashes = {a: digest.new(a) for a in set([DIGEST, digest.DEFAULT])}
+            self.fileinfo = {
+                'filename': part.filename, 'content_type': part.content_type
+            }
+
+    def part_data(self, data):
+        if self.part.filename is not None:
+            self.upload.write(data)
+            for h in self.hashes.values():
+                h.update(data)
+        else:
+            self.field.append(data)
+            if sum(len(f) for f in self.field) > MAX_FIELD_SIZE:
+                raise ValueError('form field too large')
+
+    def part_end(self):
+        if self.part.filename is None:
+            args = self.request.arguments.setdefault(self.part.name, [])
+            args.append(b''.join(self.field))
+
+    def release(self):
+        super(MainHandler, self).release()
+        if self.pinned:
+            files.checkin(self.pinned)
+            self.pinned = None
+        if self.relaying:
+            if not self.relaying.done:
+                self.relaying.fail('receiver went away')
+            self.relaying = None
+        if self.upload:
+            self.upload.abort()
+            self.upload = None
+
+    def abandon(self):
+        # the download the cut off transfer used up is given back
+        if self.pinned and self.consumed:
+            files.unconsume(self.pinned)
+
+    def check_key(self, code, key, hashed):
+        """ Rate limited key check, writes the error response on failure """
+        if not admission.key(code):
+            wait = admission.keys.retry_after(code)
+            self.error('too many attempts', 429, {'Retry-After': int(wait) + 1})
+            return False
+
+        if not key_check(key, hashed):
+            self.error('invalid key')
+            return False
+        return True
 
     def serve_file_headers(self, meta):
-        self.set_header('Content-Type', meta['content_type'])
+        self.set_header('Content-Type', meta.content_type)
         self.set_header(
-            'Content-Disposition', 'attachment; filename="{}"'.format(meta['filename'])
+            'Content-Disposition', 'attachment; filename="{}"'.format(meta.filename)
         )
+        self.digest_headers(meta)
 
     def serve_file(self, data, meta):
         self.serve_file_headers(meta)
         self.write(data)
 
     def write_formatted(self, data, meta):
-        typ = meta['content_type']
+        typ = meta.content_type
 
         if 'image' in typ:
             # display images directly in browser
-            self.write("<img src='data:%s;base64,%s'/>" % (typ, base64.b64encode(data)))
+            self.write("<img src='data:%s;base64,%s'/>" % (typ, tostring(base64.b64encode(data))))
         elif 'text' in typ:
             # display code and text in pre block
-            self.write('<pre>%s</pre>' % data)
+            self.write('<pre>%s</pre>' % tostring(data))
         else:
             # otherwise, just download the file like usual
             self.serve_file(data, meta)
@@ -297,52 +1505,92 @@ class MainHandler(Handler):
 
         if not args:
             self.finish()
+        elif self.remote(args):
+            self.forward(args)
         else:
-            if not files.exists(args):
+            r = files.relay(args)
+            meta = r.meta if r else files.lookup(args)
+            if meta is None:
                 self.error('not found')
                 return
 
-            data, meta = files.open_file(args)
             key = self.get_arg('key', '')
 
             # check the key is present if required
-            if meta['key']:
-                if not key_check(key, meta['key']):
-                    self.error('invalid key')
+            if meta.key:
+                if not self.check_key(args, key, meta.key):
                     return
 
             # write out the headers and finish
             self.serve_file_headers(meta)
             self.finish()
 
+    @tornado.gen.coroutine
+    def serve_relay(self, code, r):
+        """ Download a live relay, written out as the upload arrives """
+        if r.meta.key:
+            if not self.check_key(code, self.get_arg('key', ''), r.meta.key):
+                return
+
+        if r.receiver is not None:
+            self.error('not found')
+            return
+
+        self.relaying = r
+        self.serve_file_headers(r.meta)
+        if r.size is not None:
+            self.set_header('Content-Length', r.size)
+
+        try:
+            yield r.pull(self)
+            self.mark('relay')
+        except relay.RelayError:
+            # cut the connection so that the download can't look complete
+            self.request.connection.close()
+            return
+        finally:
+            files.end_relay(code)
+        self.finish()
+
     def get(self, args, headonly=False):
         if not args:
             args = self.get_arg('code', '')
 
         if not args:
             self.cache_headers()
-            self.write(PAGE_INDEX)
+            self.write(page('index'))
             self.finish()
         else:
-            if not files.exists(args):
+            if self.remote(args):
+                return self.forward(args)
+
+            # relays have no file, they are fed to the first download
+            r = files.relay(args)
+            if r is not None:
+                return self.serve_relay(args, r)
+
+            # pin the file so that it outlives expiry until we are done
+            data, meta = files.checkout(args)
+            if meta is None:
                 self.error('not found')
                 return
+            self.pinned = args
+            self.mark('read')
 
-            data, meta = files.open_file(args)
             key = self.get_arg('key', '')
 
             # check the key is present if required
-            if meta['key']:
-                if not key_check(key, meta['key']):
-                    self.error('invalid key')
+            if meta.key:
+                if not self.check_key(args, key, meta.key):
                     return
+                self.mark('key')
 
-            # either delete the file or update the view count in the meta data
-            meta['n'] -= 1
-            if meta['n'] == 0:
-                files.delete_file(args)
-            else:
-                files.update_meta(args, meta)
+            # use up a download, the file is deleted once the last one is done
+            if not files.consume(args):
+                self.error('not found')
+                return
+            self.consumed = True
+            self.mark('consume')
 
             # if we are on command line, just return data, otherwise display it pretty
             if self.cli():
@@ -351,85 +1599,339 @@ class MainHandler(Handler):
                 self.write_formatted(data, meta)
             else:
                 self.serve_file(data, meta)
+            self.mark('write')
             self.finish()
 
-    def get_arg(self, key, default):
-        val = self.request.arguments.get(key, [default])[0]
-        val = tostring(val)
-        return val
-
     def post(self, args):
-        meta = {}
-        codeonly = self.get_arg('codeonly', None)
-        meta['key'] = self.get_arg('key', None)
-        usern = int(self.get_arg('n', 1))
-        usern = max(min(usern, MAX_DOWNLOADS), 0)
-        meta['n'] = usern
+        self.mark('receive')
+        if self.parser is not None:
+            try:
+                self.parser.close()
+            except ValueError as e:
+                self.error(str(e), 400)
+                return
 
-        if meta['key']:
-            meta['key'] = tostring(key_hash(meta['key']))
+        meta = self.upload_meta()
+        if meta is None:
+            return
+        self.mark('meta')
+
+        # change to error occured since file already exists
+        if args and files.exists(args):
+            self.error('exists')
+            return
+
+        if self.upload is not None:
+            # we have a file attached, save it to a new file name
+            meta.update(self.fileinfo)
+            upload, self.upload = self.upload, None
+            self.save(args, upload, meta, self.hashes)
+        else:
+            self.error('no file attached')
+            return
+
+class SessionHandler(TransferHandler):
+    """
+    Resumable uploads, for large files over unreliable connections:
+
+        POST   /upload          start a session (size, chunk, filename, ...)
+        PUT    /upload/<id>/<i> upload chunk i, in any order, any number of times
+        GET    /upload/<id>     which chunks have been received
+        POST   /upload/<id>     finish the session, returns the code
+        DELETE /upload/<id>     abandon the session
+    """
+    def transfer(self):
+        # finishing reads back and hashes whatever arrived out of order
+        return self.request.method == 'POST' and bool(self.path_args)
+
+    def status(self, session):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'id': session.id, 'size': session.size,
+            'chunk_size': session.chunk_size, 'count': session.count,
+            'received': sorted(session.received),
+        }))
+        self.finish()
+
+    def get(self, sid):
+        session = files.session(sid)
+        if session is None:
+            self.error('not found')
+            return
+        self.status(session)
+
+    def delete(self, sid):
+        files.end_session(sid)
+        self.finish()
 
+    def post(self, sid=None):
+        if sid is None:
+            self.create()
+        else:
+            self.complete(sid)
+
+    def create(self):
         try:
-            time = dt2date(self.get_arg('time', '3 days'))
-        except Exception as e:
-            self.error('invalid time')
+            size = int(self.get_arg('size', ''))
+            chunk = int(self.get_arg('chunk', CHUNK_SIZE))
+        except ValueError:
+            self.error('invalid size', 400)
             return
 
-        # limit the time between valid parameters
-        tmin = dt2date('1 min')
-        tmax = dt2date('7 days')
-        time = max(tmin, min(tmax, time))
-        meta['time'] = time.isoformat()
+        if size > MAX_SESSION_SIZE or size < 0:
+            self.error('Filesize > {}GB'.format(MAX_SESSION_SIZE // 10**9), 413)
+            return
 
-        # change to error occured since file already exists
-        if args and files.exists(args):
+        code = self.get_arg('code', '')
+        if self.remote(code):
+            self.forward(code)
+            return
+
+        if code and files.exists(code):
             self.error('exists')
             return
 
-        if len(self.request.files) == 1:
-            # we have files attached, save each of them to new file names
-            name = args or files.unique_code()
+        meta = self.upload_meta()
+        if meta is None:
+            return
 
-            if name is None:
-                self.error("no codes available")
-                return
+        meta['filename'] = self.get_arg('filename', 'upload')
+        meta['content_type'] = self.get_arg('content_type', 'application/unknown')
+        meta['code'] = code
 
-            fobj = list(self.request.files.values())[0][0]
+        chunk = max(CHUNK_MIN, min(CHUNK_MAX, chunk))
+        self.status(files.new_session(size, chunk, meta))
 
-            # separate the actual contents from the meta data
-            body = fobj.pop('body')
-            meta.update(fobj)
+    def complete(self, sid):
+        session = files.session(sid)
+        if session is None:
+            self.error('not found')
+            return
 
-            # strip paths from meta name (can't be done on client)
-            if 'filename' in meta:
-                meta['filename'] = os.path.basename(meta['filename'])
+        if not session.complete():
+            self.error('missing chunks {}'.format(session.missing()), 409)
+            return
 
-            # write the file and return the accepted name
-            files.save_file(name, body, meta)
+        meta = dict(session.meta)
+        code = meta.pop('code')
+        files.end_session(sid, abort=False)
+        self.save(code, session, meta, session.digests())
 
-            if not self.cli() and not codeonly:
-                response = TMPL_CODE.substitute(namecode=name)
-                self.write(response)
-            else:
-                self.write(name)
-            self.finish()
+@tornado.web.stream_request_body
+class ChunkHandler(TransferHandler):
+    """ PUT /upload/<id>/<i>, written in place as the body arrives """
+    def prepare(self, *args, **kwargs):
+        self.fd = None
+        self.rejected = False
+        self.written = 0
+        super(ChunkHandler, self).prepare(*args, **kwargs)
+        if self._finished:
+            return
 
+        sid, index = self.path_args[0], int(self.path_args[1])
+        self.session = files.session(sid)
+        if self.session is None:
+            self.error('not found')
             return
-        elif len(self.request.files) == 0:
-            self.error('no file attached')
+
+        if index >= self.session.count:
+            self.error('invalid chunk', 400)
             return
-        else:
-            self.error("one file at a time")
+
+        self.index = index
+        self.offset = self.session.offset(index)
+        self.expected = self.session.length(index)
+        self.request.connection.set_max_body_size(self.expected)
+
+        # an optional digest of the chunk is checked before it is accepted,
+        # and the session's digest advances if this is the next chunk in order
+        algo, self.chunk_digest = digest.parse(self.request.headers.get('Digest'))
+        self.chunk_hash = digest.new(algo) if algo else None
+        self.hashes = None
+        self.pieces = None
+        if index == self.session.hashed:
+            self.hashes = {a: h.copy() for a, h in self.session.hashes.items()}
+        elif index > self.session.hashed:
+            self.pieces = []
+
+        self.fd = os.open(self.session.path, os.O_WRONLY)
+
+    def data_received(self, chunk):
+        if self.rejected or self.fd is None:
+            return
+
+        if self.written + len(chunk) > self.expected:
+            self.rejected = True
+            self.error('chunk too long', 400)
+            return
+
+        pwrite(self.fd, chunk, self.offset + self.written)
+        self.written += len(chunk)
+
+        for h in list((self.hashes or {}).values()) + [self.chunk_hash]:
+            if h is not None:
+                h.update(chunk)
+        if self.pieces is not None:
+            self.pieces.append(chunk)
+
+    def put(self, sid, index):
+        if self.written != self.expected:
+            self.error('chunk too short', 400)
+            return
+
+        if self.chunk_hash and self.chunk_hash.hexdigest() != self.chunk_digest:
+            self.error('digest mismatch', 400)
+            return
+
+        data = b''.join(self.pieces) if self.pieces is not None else None
+        self.session.mark(self.index, self.hashes, data)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'received': len(self.session.received), 'count': self.session.count
+        }))
+        self.finish()
+
+    def release(self):
+        super(ChunkHandler, self).release()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+@tornado.web.stream_request_body
+class RelayHandler(TransferHandler):
+    """
+    Live relays, for one-shot transfers which never wait on the disk:
+
+        POST /relay        claim a code (filename, content_type, size, key,
+                           code, spool), returns the code and a send token
+        PUT  /relay/<code> send the file as the body, with ?token=, which is
+                           passed on to whoever GETs /<code> as it arrives
+
+    The sender is held back to the downloader's pace. Without spool it waits
+    for the downloader to attach, with it the file goes to disk until then.
+    """
+    def prepare(self, *args, **kwargs):
+        self.relay = None
+        super(RelayHandler, self).prepare(*args, **kwargs)
+        if self._finished or self.request.method != 'PUT':
+            return
+
+        r = files.relay(self.path_args[0] if self.path_args else '')
+        if r is None or r.sender or r.error or self.get_arg('token', '') != r.token:
+            self.error('not found')
+            return
+
+        r.sender = True
+        self.relay = r
+        self.request.connection.set_max_body_size(MAX_RELAY_SIZE)
+
+    def transfer(self):
+        return self.request.method == 'PUT'
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        if self.relay is None or self._finished:
+            return
+
+        try:
+            yield self.relay.push(chunk)
+        except relay.RelayError as e:
+            self.error(str(e), 502)
+
+    def post(self, code=None):
+        if code is not None:
+            self.error('not found', 405)
+            return
+
+        try:
+            size = self.get_arg('size', '')
+            size = int(size) if size else None
+        except ValueError:
+            self.error('invalid size', 400)
             return
 
-def serve(root=None, port='8888', addr='127.0.0.1'):
-    global files
-    files = FileManager()
+        if size is not None and (size > MAX_RELAY_SIZE or size < 0):
+            self.error('Filesize > {}GB'.format(MAX_RELAY_SIZE // 10**9), 413)
+            return
+
+        meta = self.upload_meta()
+        if meta is None:
+            return
+
+        meta['n'] = 1
+        meta['filename'] = os.path.basename(self.get_arg('filename', 'upload'))
+        meta['content_type'] = self.get_arg('content_type', 'application/unknown')
+
+        code = self.get_arg('code', '')
+        if self.remote(code):
+            self.forward(code)
+            return
+
+        spool = bool(self.get_arg('spool', ''))
+        r = files.new_relay(code, record.Meta(**meta), size, spool=spool)
+        if r is None:
+            self.error('exists' if code else 'no codes available')
+            return
+
+        tornado.ioloop.IOLoop.current().call_later(RELAY_WAIT, self.expire, r)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'code': r.code, 'token': r.token}))
+        self.finish()
+
+    def put(self, code):
+        if self._finished:
+            return
+        self.relay.close()
+        self.write(code)
+        self.finish()
+
+    def release(self):
+        super(RelayHandler, self).release()
+        if self.relay is not None and not self.relay.done:
+            files.end_relay(self.relay.code, 'sender went away')
+        self.relay = None
+
+    @staticmethod
+    def expire(r):
+        """ Drop a relay nobody came to download """
+        if r.receiver is None and files.relay(r.code) is r:
+            files.end_relay(r.code, 'nobody downloaded')
+
+def serve(root=None, port='8888', addr='127.0.0.1', digest_algo=None,
+        durability=DURABILITY, fsync_interval=FSYNC_INTERVAL,
+        client_rate=CLIENT_RATE, key_rate=KEY_RATE, max_inflight=MAX_INFLIGHT,
+        cache_size=CACHE_SIZE, cache_max_file=CACHE_MAX_FILE,
+        shard_depth=SHARD_DEPTH, cluster=None, profiling=False,
+        timing_header=False, drain_timeout=DRAIN_TIMEOUT, restart=None):
+    global files, admission, peers, timings, server_timing, DIGEST
+    global server, sockets, drain_wait, restart_command
+    DIGEST = digest_algo or DIGEST
+    peers = cluster
+    timings = debug.Timings(TIMING_HISTORY) if profiling else None
+    server_timing = timing_header
+    drain_wait = drain_timeout
+    restart_command = restart
+    if peers is not None and not 0 < peers.prefix <= CODE_LEN:
+        raise ValueError("Cluster prefix must be at most the code length")
+
+    admission = limits.Admission(
+        client_rate=client_rate[0], client_burst=client_rate[1],
+        key_rate=key_rate[0], key_burst=key_rate[1], max_inflight=max_inflight
+    )
+    files = FileManager(
+        durability=durability, interval=fsync_interval,
+        cache_size=cache_size, cache_max_file=cache_max_file,
+        depth=shard_depth, partition=peers.owns if peers else None
+    )
     files.init(root)
 
     tornado.log.enable_pretty_logging()
-    app = Application()
-    app.listen(port, addr)
-    signal.signal(signal.SIGINT, signal_handler)
-    tornado.ioloop.IOLoop.instance().start()
+    sockets = listen(port, addr)
+    server = tornado.httpserver.HTTPServer(Application())
+    server.add_sockets(sockets)
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    handle_signals(ioloop)
+    ioloop.add_callback(ready)
+    ioloop.start()
 